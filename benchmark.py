@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+from validate_email import validate_email
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import re
+import resource
+import run_all
+import shutil
+import sys
+import tempfile
+import time
+import util
+
+# Anything that looks like it could be an email, as scrapers come across them.
+EMAIL_CANDIDATE_RE = re.compile(r'[^\s<>"\'(),;:]+@[^\s<>"\'(),;:]+')
+
+# Recorded pages for every scraper, as <school>/<key>/<page>.html where key is
+# what the scraper's parse() takes besides the page, if anything.  Scale-ups
+# repeat each part of a page between ROWS_BEGIN and ROWS_END.
+FIXTURES_DIR = os.path.join(run_all.SCRIPT_DIR, 'fixtures')
+ROWS_BEGIN = '<!-- rows -->'
+ROWS_END = '<!-- /rows -->'
+ROWS_RE = re.compile(
+    '(%s.*?%s)' % (re.escape(ROWS_BEGIN), re.escape(ROWS_END)), re.DOTALL)
+SCALES = [1, 300]
+# The suite times each backend on a whole tree, and 'stream', which is lxml
+# with STREAM_ROWS for the scrapers that support it.
+SUITE_BACKENDS = ['stream'] + util.BACKENDS
+# A case regresses against the baseline if it yields different rows, or its
+# rows/s drop or its peak memory grows by more than TOLERANCE.  Cases quicker
+# than MIN_SECS are too noisy to compare throughput, and memory growth under
+# MIN_MEMORY_MB is noise too.
+TOLERANCE = 0.3
+MIN_SECS = 0.05
+MIN_MEMORY_MB = 2.0
+
+def find_pages(download_dir):
+  pages = []
+  for root, _, files in os.walk(download_dir):
+    for name in files:
+      if name.endswith('.html'):
+        pages.append(os.path.join(root, name))
+  return sorted(pages)
+
+def time_parse(page, backend, repeat):
+  # Best of repeat runs, in seconds.
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    util.make_soup(page, backend)
+    secs = time.time() - start
+    if best is None or secs < best:
+      best = secs
+  return best
+
+def find_email_candidates(pages):
+  candidates = []
+  for page in pages:
+    with open(page, 'rb') as fp:
+      content = fp.read().decode('utf-8', 'replace')
+    candidates.extend(EMAIL_CANDIDATE_RE.findall(content))
+  return candidates
+
+def time_best(func, repeat):
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    result = func()
+    secs = time.time() - start
+    if best is None or secs < best:
+      best = secs
+  return best, result
+
+def benchmark_emails(pages, repeat, scale):
+  # Per item validate_email, as the scrapers used to call it, against one
+  # util.clean_emails batch with a cold domain memo.
+  candidates = find_email_candidates(pages) * scale
+  assert candidates, 'no email candidates in %d pages' % len(pages)
+  def per_item():
+    return [email if validate_email(email) else None for email in candidates]
+  def batch():
+    util._email_domains.clear()
+    return util.clean_emails(candidates)
+  per_item_secs, per_item_valid = time_best(per_item, repeat)
+  batch_secs, batch_valid = time_best(batch, repeat)
+  differ = sum(1 for a, b in zip(per_item_valid, batch_valid)
+               if (a is None) != (b is None))
+  print '%d candidates (%d distinct) from %d pages' % (
+      len(candidates), len(set(candidates)), len(pages))
+  for name, secs, valid in (
+      ('validate_email', per_item_secs, per_item_valid),
+      ('clean_emails', batch_secs, batch_valid)):
+    print '%-16s %10.2f ms %12.0f emails/s %6d valid' % (
+        name, secs * 1000, len(candidates) / max(secs, 1e-9),
+        sum(1 for email in valid if email is not None))
+  print 'clean_emails: %.1fx faster, %d verdicts differ' % (
+      per_item_secs / max(batch_secs, 1e-9), differ)
+
+def scale_page(content, scale):
+  return ''.join(part * scale if part.startswith(ROWS_BEGIN) else part
+                 for part in ROWS_RE.split(content))
+
+def find_fixtures(fixtures_dir, school):
+  # (page, key) for each fixture of school.
+  fixtures = []
+  for page in find_pages(os.path.join(fixtures_dir, school)):
+    fixtures.append((page, os.path.basename(os.path.dirname(page))))
+  return fixtures
+
+def scale_fixtures(fixtures, fixtures_dir, scale, scaled_dir):
+  scaled = []
+  for page, key in fixtures:
+    scaled_page = os.path.join(
+        scaled_dir, os.path.relpath(page, fixtures_dir))
+    if not os.path.isdir(os.path.dirname(scaled_page)):
+      os.makedirs(os.path.dirname(scaled_page))
+    with open(page, 'rb') as fp:
+      content = fp.read()
+    with open(scaled_page, 'wb') as fp:
+      fp.write(scale_page(content, scale))
+    scaled.append((scaled_page, key))
+  return scaled
+
+def parse_fixture(module, page, key, errors):
+  # Quarantines failing rows into errors, as util.cached_parse would.
+  with util.quarantining(page, errors):
+    if len(inspect.getargspec(module.parse).args) == 2:
+      return module.parse(page, key)
+    return module.parse(page)
+
+def parse_fixtures(module, fixtures):
+  # (rows, quarantined rows) of all fixtures.
+  rows = 0
+  errors = []
+  for page, key in fixtures:
+    rows += len(parse_fixture(module, page, key, errors))
+  return rows, len(errors)
+
+def in_child(func):
+  # Returns func()'s result as {'result': ...} or {'error': ...}, with the
+  # growth of resident memory it peaked at in 'peak_mb'.  func runs in a
+  # forked child so that each measurement starts from the same memory.
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+      result = {'result': func()}
+    except Exception as e:
+      result = {'error': repr(e)}
+    result['start_kb'] = start_kb
+    with os.fdopen(write_fd, 'w') as fp:
+      json.dump(result, fp)
+    os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as fp:
+    result = json.load(fp)
+  _, _, usage = os.wait4(pid, 0)
+  result['peak_mb'] = (usage.ru_maxrss - result.pop('start_kb')) / 1024.0
+  return result
+
+def benchmark_scraper(school, fixtures, backend, repeat):
+  # Best of repeat passes of school's parse() over fixtures, silencing the
+  # scraper's logging.
+  def run():
+    util.PARSER = 'lxml' if backend == 'stream' else backend
+    util.STREAM_ROWS = backend == 'stream'
+    util.PARSE_CACHE = False
+    module = importlib.import_module(run_all.MODULE_PREFIX + school)
+    sys.stdout = open(os.devnull, 'w')
+    return time_best(lambda: parse_fixtures(module, fixtures), repeat)
+  return in_child(run)
+
+def get_case(result):
+  return '%s/%s/x%d' % (result['scraper'], result['backend'], result['scale'])
+
+def benchmark_suite(fixtures_dir, schools, backends, scales, repeat):
+  results = []
+  scaled_dir = tempfile.mkdtemp(prefix='benchmark')
+  print '%-12s %-16s %6s %6s %8s %6s %10s %10s %12s %8s' % (
+      'scraper', 'backend', 'scale', 'pages', 'rows', 'quar', 'ms', 'pages/s',
+      'rows/s', 'peak MB')
+  try:
+    for school in schools:
+      fixtures = find_fixtures(fixtures_dir, school)
+      assert fixtures, 'no fixtures for %s under %s' % (school, fixtures_dir)
+      for scale in scales:
+        scaled = fixtures
+        if scale != 1:
+          scaled = scale_fixtures(fixtures, fixtures_dir, scale,
+                                  os.path.join(scaled_dir, str(scale)))
+        for backend in backends:
+          run = benchmark_scraper(school, scaled, backend, repeat)
+          result = {'scraper': school, 'backend': backend, 'scale': scale,
+                    'pages': len(scaled), 'peak_mb': run['peak_mb']}
+          if 'error' in run:
+            result['error'] = run['error']
+            print '%-12s %-16s %6d %6d FAILED: %s' % (
+                school, backend, scale, len(scaled), run['error'])
+          else:
+            secs, (rows, quarantined) = run['result']
+            secs = max(secs, 1e-9)
+            result.update({'rows': rows, 'quarantined': quarantined,
+                           'secs': secs,
+                           'pages_per_sec': len(scaled) / secs,
+                           'rows_per_sec': rows / secs})
+            print '%-12s %-16s %6d %6d %8d %6d %10.2f %10.1f %12.1f %8.1f' % (
+                school, backend, scale, len(scaled), rows, quarantined,
+                secs * 1000,
+                result['pages_per_sec'], result['rows_per_sec'],
+                result['peak_mb'])
+          results.append(result)
+  finally:
+    shutil.rmtree(scaled_dir)
+  return results
+
+def find_regressions(results, baseline, tolerance):
+  regressions = []
+  base = dict((get_case(result), result) for result in baseline)
+  for result in results:
+    case = get_case(result)
+    old = base.get(case)
+    if old is None:
+      continue
+    if 'error' in result:
+      if 'error' not in old:
+        regressions.append('%s: failed (%s)' % (case, result['error']))
+      continue
+    if 'error' in old:
+      continue
+    if result['rows'] != old['rows']:
+      regressions.append('%s: %d rows, was %d' % (
+          case, result['rows'], old['rows']))
+    if result['quarantined'] > old['quarantined']:
+      regressions.append('%s: %d rows quarantined, was %d' % (
+          case, result['quarantined'], old['quarantined']))
+    if (max(result['secs'], old['secs']) >= MIN_SECS
+        and result['rows_per_sec'] < old['rows_per_sec'] * (1 - tolerance)):
+      regressions.append('%s: %.1f rows/s, was %.1f' % (
+          case, result['rows_per_sec'], old['rows_per_sec']))
+    if (result['peak_mb'] > old['peak_mb'] * (1 + tolerance)
+        and result['peak_mb'] - old['peak_mb'] >= MIN_MEMORY_MB):
+      regressions.append('%s: peak %.1f MB, was %.1f' % (
+          case, result['peak_mb'], old['peak_mb']))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Times each parser backend, or email validation, on saved '
+      'download pages, or with --suite every scraper on the fixture pages.')
+  parser.add_argument('--download_dir',
+                      help='searched recursively for *.html')
+  parser.add_argument('--backends', default=None,
+                      help='comma separated, all by default')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--emails', action='store_true',
+                      help='time email validation instead of parsing')
+  parser.add_argument('--email_scale', type=int, default=1,
+                      help='repeat the email candidates this many times')
+  parser.add_argument('--suite', action='store_true',
+                      help='time every scraper on the fixture pages, and '
+                      'scale-ups of them')
+  parser.add_argument('--fixtures_dir', default=FIXTURES_DIR)
+  parser.add_argument('--schools', default=None,
+                      help='comma separated subset of scrapers for --suite')
+  parser.add_argument('--scales', default=','.join(str(s) for s in SCALES),
+                      help='times to repeat the rows of each fixture page')
+  parser.add_argument('--results', default=None,
+                      help='json file to write the --suite results to')
+  parser.add_argument('--baseline', default=None,
+                      help='--suite results to compare with, exiting with '
+                      'status 1 on a regression')
+  parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+  args = parser.parse_args()
+
+  if args.suite:
+    backends = SUITE_BACKENDS
+    if args.backends is not None:
+      backends = args.backends.split(',')
+    for backend in backends:
+      assert backend in SUITE_BACKENDS, 'unknown backend: %s' % backend
+    schools = run_all.discover_schools()
+    if args.schools is not None:
+      selected = args.schools.split(',')
+      for school in selected:
+        assert school in schools, 'unknown school: %s' % school
+      schools = selected
+    # Imported up front so that no measurement includes it.
+    for school in schools:
+      importlib.import_module(run_all.MODULE_PREFIX + school)
+    results = benchmark_suite(
+        args.fixtures_dir, schools, backends,
+        [int(scale) for scale in args.scales.split(',')], args.repeat)
+    if args.results is not None:
+      with open(args.results, 'w') as fp:
+        json.dump(results, fp, indent=1, sort_keys=True)
+    if args.baseline is not None:
+      with open(args.baseline) as fp:
+        regressions = find_regressions(results, json.load(fp), args.tolerance)
+      for regression in regressions:
+        print 'REGRESSION %s' % regression
+      print '%d regressions against %s' % (len(regressions), args.baseline)
+      if regressions:
+        sys.exit(1)
+    return
+
+  assert args.download_dir is not None, '--download_dir is required'
+  backends = util.BACKENDS
+  if args.backends is not None:
+    backends = args.backends.split(',')
+  for backend in backends:
+    assert backend in util.BACKENDS, 'unknown backend: %s' % backend
+  pages = find_pages(args.download_dir)
+  assert pages, 'no html pages under %s' % args.download_dir
+  if args.emails:
+    benchmark_emails(pages, args.repeat, args.email_scale)
+    return
+
+  print '%-60s %8s %s' % ('page', 'KB', ' '.join(
+      '%16s' % ('%s ms' % b) for b in backends))
+  totals = dict((backend, 0.0) for backend in backends)
+  for page in pages:
+    times = []
+    for backend in backends:
+      secs = time_parse(page, backend, args.repeat)
+      totals[backend] += secs
+      times.append(secs)
+    name = os.path.relpath(page, args.download_dir)
+    print '%-60s %8.1f %s' % (name[-60:], os.path.getsize(page) / 1024.0,
+                              ' '.join('%16.2f' % (t * 1000) for t in times))
+  print '%-60s %8s %s' % ('total (%d pages)' % len(pages), '', ' '.join(
+      '%16.2f' % (totals[backend] * 1000) for backend in backends))
+  base = backends[-1]
+  for backend in backends[:-1]:
+    print '%s: %.1fx faster than %s' % (
+        backend, totals[base] / max(totals[backend], 1e-9), base)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import sqlite3
+import util
+
+# Table of merged people, with a row in names for the full normalized name and
+# for each suffix of it starting at a word, so a prefix of any name part hits.
+SCHEMA = """
+CREATE TABLE people (
+  id INTEGER PRIMARY KEY,
+  email_key TEXT UNIQUE,
+  name_key TEXT NOT NULL,
+  name TEXT NOT NULL,
+  email TEXT,
+  title TEXT,
+  school TEXT,
+  sources TEXT NOT NULL
+);
+CREATE TABLE names (
+  key TEXT NOT NULL,
+  person_id INTEGER NOT NULL
+);
+CREATE INDEX names_key ON names (key);
+"""
+
+MAX_RESULTS = 50
+
+def normalize_email(email):
+  if not email:
+    return None
+  email = email.strip().lower()
+  if email.startswith('mailto:'):
+    email = email[len('mailto:'):]
+  return email or None
+
+def get_name_keys(name_key):
+  parts = name_key.split(' ')
+  return [' '.join(parts[i:]) for i in range(len(parts))]
+
+class Person(object):
+  def __init__(self, record, email_key, name_key):
+    self.email_key = email_key
+    self.name_key = name_key
+    self.name = record['name']
+    self.email = record['email']
+    self.title = record['title']
+    self.school = record['school']
+    self.sources = []
+
+  def merge(self, record, email_key):
+    # Fills in a missing email and takes the title (and its school) from
+    # whichever record ranks first in util.Title.PRECEDENCE.
+    if self.email_key is None and email_key is not None:
+      self.email_key = email_key
+      self.email = record['email']
+    if util.Title.rank(record['title']) < util.Title.rank(self.title):
+      self.title = record['title']
+      self.school = record['school']
+    self.sources.append(dict(
+        (field, record[field])
+        for field in ('title', 'school', 'source_url', 'page')))
+
+def dedup(records):
+  # Records with the same normalized email are one person.  A record without
+  # an email, or whose email is not yet known, joins a person of the same
+  # school and normalized name unless their emails differ.
+  people = []
+  by_email = {}
+  by_name = {}
+  for record in records:
+    email_key = normalize_email(record['email'])
+    name_key = util.get_name_key(record['name'] or '')
+    if not name_key:
+      continue
+    person = by_email.get(email_key) if email_key is not None else None
+    if person is None:
+      person = by_name.get((record['school'], name_key))
+      if (person is not None and email_key is not None
+          and person.email_key not in (None, email_key)):
+        person = None
+    if person is None:
+      person = Person(record, email_key, name_key)
+      people.append(person)
+    person.merge(record, email_key)
+    by_name.setdefault((record['school'], name_key), person)
+    if person.email_key is not None:
+      by_email[person.email_key] = person
+  return people
+
+def build(output_files, index_file):
+  # Writes the index to a temp file and renames it, so readers always see a
+  # complete index.
+  records = []
+  for output_file in output_files:
+    records.extend(util.read_records(output_file))
+  people = dedup(records)
+  tmp_file = '%s.tmp' % index_file
+  if os.path.exists(tmp_file):
+    os.remove(tmp_file)
+  db = sqlite3.connect(tmp_file)
+  db.executescript(SCHEMA)
+  for i, person in enumerate(people):
+    db.execute('INSERT INTO people VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+        i, person.email_key, person.name_key, person.name, person.email,
+        person.title, person.school, json.dumps(person.sources)))
+    # Keyed by the words search_name folds prefixes to, suffixes included.
+    db.executemany('INSERT INTO names VALUES (?, ?)', [
+        (key, i) for key in get_name_keys(
+            util.get_name_prefix_key(person.name))])
+  db.commit()
+  db.close()
+  os.rename(tmp_file, index_file)
+  return len(records), len(people)
+
+class PeopleIndex(object):
+  COLUMNS = ['name', 'email', 'title', 'school', 'sources']
+
+  def __init__(self, index_file):
+    assert os.path.isfile(index_file), 'no index at %s' % index_file
+    self.db = sqlite3.connect(index_file)
+
+  def to_person(self, row):
+    person = dict(zip(self.COLUMNS, row))
+    person['sources'] = json.loads(person['sources'])
+    return person
+
+  def lookup_email(self, email):
+    row = self.db.execute(
+        'SELECT %s FROM people WHERE email_key = ?' % ', '.join(self.COLUMNS),
+        (normalize_email(email),)).fetchone()
+    return self.to_person(row) if row is not None else None
+
+  def search_name(self, prefix, limit=MAX_RESULTS):
+    # People with a name, or a name part onwards, starting with prefix.
+    prefix = util.get_name_prefix_key(prefix)
+    if not prefix:
+      return []
+    rows = self.db.execute(
+        'SELECT %s FROM people WHERE id IN ('
+        'SELECT person_id FROM names WHERE key >= ? AND key < ?) '
+        'ORDER BY name_key LIMIT ?' % ', '.join(self.COLUMNS),
+        (prefix, prefix + u'\U0010ffff', limit)).fetchall()
+    return [self.to_person(row) for row in rows]
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Builds and queries an index of the people scraped for all '
+      'schools.')
+  parser.add_argument('--index_file', required=True)
+  subparsers = parser.add_subparsers(dest='command')
+  build_parser = subparsers.add_parser('build')
+  build_parser.add_argument('--data_dir', required=True,
+                            help='reads <data_dir>/<school>/processed')
+  build_parser.add_argument('--output_format',
+                            choices=util.OUTPUT_FORMATS.keys(),
+                            default=util.OUTPUT_FORMAT)
+  email_parser = subparsers.add_parser('email')
+  email_parser.add_argument('email')
+  name_parser = subparsers.add_parser('name')
+  name_parser.add_argument('prefix')
+  name_parser.add_argument('--limit', type=int, default=MAX_RESULTS)
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    output_files = []
+    for school in sorted(os.listdir(args.data_dir)):
+      processed_dir = '%s/%s/processed' % (args.data_dir, school)
+      if os.path.isdir(processed_dir):
+        output_files.extend(
+            util.find_output_files(processed_dir, args.output_format))
+    records, people = build(output_files, args.index_file)
+    print 'indexed %d people from %d records in %d files' % (
+        people, records, len(output_files))
+    return
+  index = PeopleIndex(args.index_file)
+  if args.command == 'email':
+    people = [index.lookup_email(args.email)]
+  else:
+    people = index.search_name(args.prefix.decode('utf-8'), args.limit)
+  for person in people:
+    if person is not None:
+      print json.dumps(person, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
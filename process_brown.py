@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
 import os
 import util
 
+SCHOOL = 'brown'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 2
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'https://cs.brown.edu/people/grad/': 'grad',
@@ -30,6 +33,12 @@ GRAD_LINK_SUFFIX = '/'
 UNDERGRAD_LINK_PREFIX = '/people/ugrad/'
 UNDERGRAD_LINK_SUFFIX = '/'
 
+DIR_TABLE_SELECTOR = 'table#deptdir'
+
+# The part of each page the extraction looks at, parsed alone.
+UNDERGRAD_REGION = util.Region('ul.profile-list.profile-compact')
+DIR_REGION = util.Region(DIR_TABLE_SELECTOR)
+
 DIR_TEXT_TITLE_MAP = {
     'PhD Student': util.Title.PHD,
     'Masters Student': util.Title.MASTER,
@@ -39,6 +48,8 @@ DIR_TEXT_TITLE_MAP = {
     'Visitor': util.Title.STAFF,
 }
 
+DIR_TITLE_CLASSIFIER = util.TitleClassifier(DIR_TEXT_TITLE_MAP)
+
 counts = {
     'phd': 0,
     'master': 0,
@@ -47,10 +58,6 @@ counts = {
     'postdoc': 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
 def get_email(a, prefix, suffix):
   email = None
   for aa in a:
@@ -70,21 +77,21 @@ def process_grad(soup):
     title = GRAD_ID_TITLE_MAP[h2.attrs['id']]
     ul = h2.findNextSibling('ul', class_='profile-list')
     uls = ul.find_all('ul')
-    for ul in uls:
-      name_li = ul.find_all('li', class_='profile-name')
-      assert len(name_li) == 1, li
-      name = name_li[0].get_text().strip()
-      assert name != ''
-      title_li = ul.find_all('li', class_='profile-title')
-      assert len(title_li) == 1, li
-      assert title_li[0].get_text().strip() == GRAD_TITLE_TEXT_MAP[title]
-      link_li = ul.find_all('li', class_='profile-link')
-      assert len(link_li) == 1, li
-      a = link_li[0].find_all('a')
-      email = get_email(
-          link_li[0].find_all('a'), GRAD_LINK_PREFIX, GRAD_LINK_SUFFIX)
-      items.append({'name': name, 'title': title, 'email': email})
-      counts[title] += 1
+    for i, ul in enumerate(uls):
+      with util.quarantine(i, ul):
+        name_li = ul.find_all('li', class_='profile-name')
+        assert len(name_li) == 1, ul
+        name = name_li[0].get_text().strip()
+        assert name != ''
+        title_li = ul.find_all('li', class_='profile-title')
+        assert len(title_li) == 1, ul
+        assert title_li[0].get_text().strip() == GRAD_TITLE_TEXT_MAP[title]
+        link_li = ul.find_all('li', class_='profile-link')
+        assert len(link_li) == 1, ul
+        email = get_email(
+            link_li[0].find_all('a'), GRAD_LINK_PREFIX, GRAD_LINK_SUFFIX)
+        items.append({'name': name, 'title': title, 'email': email})
+        counts[title] += 1
   return items
 
 def process_undergrad(soup):
@@ -92,24 +99,26 @@ def process_undergrad(soup):
   assert len(uls) == 1
   uls = uls[0].find_all('ul')
   items = []
-  for ul in uls:
-    name_li = ul.find_all('li', class_='profile-name')
-    assert len(name_li) == 1, li
-    name = name_li[0].get_text().strip()
-    assert name != ''
-    link_li = ul.find_all('li', class_='profile-link')
-    assert len(link_li) == 1, li
-    email = get_email(
-        link_li[0].find_all('a'), UNDERGRAD_LINK_PREFIX, UNDERGRAD_LINK_SUFFIX)
-    items.append({'name': name, 'title': util.Title.UNDERGRAD, 'email': email})
-    counts['undergrad'] += 1
+  for i, ul in enumerate(uls):
+    with util.quarantine(i, ul):
+      name_li = ul.find_all('li', class_='profile-name')
+      assert len(name_li) == 1, ul
+      name = name_li[0].get_text().strip()
+      assert name != ''
+      link_li = ul.find_all('li', class_='profile-link')
+      assert len(link_li) == 1, ul
+      email = get_email(link_li[0].find_all('a'), UNDERGRAD_LINK_PREFIX,
+                        UNDERGRAD_LINK_SUFFIX)
+      items.append(
+          {'name': name, 'title': util.Title.UNDERGRAD, 'email': email})
+      counts['undergrad'] += 1
   return items
 
 def get_dir_title(td):
-  return DIR_TEXT_TITLE_MAP.get(td.get_text().strip(), None)
+  return DIR_TITLE_CLASSIFIER.classify(td.get_text())
 
 def process_dir(soup):
-  tables = soup.find_all('table', id='deptdir')
+  tables = soup.select(DIR_TABLE_SELECTOR)
   assert len(tables) == 1
   trs = tables[0].find_all('tr')
   # Check header.
@@ -118,54 +127,72 @@ def process_dir(soup):
       'Name', 'Office', 'Phone', 'Status', 'Email', 'Assistant']
   items = []
   for i in range(1, len(trs)):
-    tds = trs[i].find_all('td')
-    title = get_dir_title(tds[3])
-    if title is None:
-      continue
-    name = tds[0].get_text().strip()
-    last, first = name.split(', ')
-    name = '%s %s' % (first, last)
-    assert name != ''
-    user = tds[4].get_text().strip()
-    if user != '':
-      email = '%s@brown.edu' % user
-    items.append({'name': name, 'title': title, 'email': email})
-    counts[title] += 1
+    with util.quarantine(i, trs[i]):
+      tds = trs[i].find_all('td')
+      title = get_dir_title(tds[3])
+      if title is None:
+        continue
+      name = util.normalize_name(tds[0].get_text())
+      assert name != ''
+      user = tds[4].get_text().strip()
+      if user != '':
+        email = '%s@brown.edu' % user
+      items.append({'name': name, 'title': title, 'email': email})
+      counts[title] += 1
   return items
 
-def process(download_file, key, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
-  soup = BeautifulSoup(open(download_file), 'html.parser')
+def parse(download_file, key):
+  region = None
   if key == 'grad':
-    items = process_grad(soup)
+    extract = process_grad
   elif key == 'undergrad':
-    items = process_undergrad(soup)
+    extract = process_undergrad
+    region = UNDERGRAD_REGION
   else:
     assert key == 'dir', key
-    items = process_dir(soup)
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+    extract = process_dir
+    region = DIR_REGION
+  return util.parse_with_fallback(download_file, extract, counts,
+                                  region=region)
 
-def download_and_process(url, key, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, key, processed_dir)
-
-def main():
+def process(download_file, key, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
+
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, subdir, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,12 +1,13 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
-from validate_email import validate_email
-
 import argparse
 import os
 import util
 
+SCHOOL = 'caltech_cms'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 3
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'http://www.cms.caltech.edu/people/grad': 'grad',
@@ -30,11 +31,20 @@ POSITION_TITLE_MAP = {
     'visitor': util.Title.STAFF,
 }
 
+TITLE_CLASSIFIER = util.TitleClassifier(
+    POSITION_TITLE_MAP, strict=True, ignore_case=True)
+
 HOME_PREFIX = 'http://directory.caltech.edu/cgi-bin/search.cgi?uid='
 
 GRAD_DIV_CLASS = 'dynamic-2col no-height'
 POSTDOC_UL_CLASS = 'no-list-style'
 DIR_TABLE_CLASS = 'table1'
+DIR_TABLE_SELECTOR = 'table.%s' % DIR_TABLE_CLASS
+
+# The part of each page the extraction looks at, parsed alone.
+GRAD_REGION = util.Region('div.%s' % '.'.join(GRAD_DIV_CLASS.split()))
+POSTDOC_REGION = util.Region('ul.%s' % POSTDOC_UL_CLASS)
+DIR_REGION = util.Region(DIR_TABLE_SELECTOR)
 
 counts = {
     'total': 0,
@@ -43,120 +53,145 @@ counts = {
     'dir': 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
 def get_email(a):
   href = a['href'].strip()
   assert href.startswith(HOME_PREFIX)
-  email = '%s@caltech.edu' % href[len(HOME_PREFIX):]
-  assert validate_email(email), 'invalid email: %s' % email
+  email = util.clean_email('%s@caltech.edu' % href[len(HOME_PREFIX):])
+  assert email is not None, 'invalid email: %s' % href
   return email
 
-def process_grad(download_file):
-  soup = BeautifulSoup(open(download_file), 'html.parser')
+def process_grad(soup):
   divs = soup.find_all('div', class_=GRAD_DIV_CLASS)
   assert len(divs) == 1, 'found %d divs of class "%s"' % (
       len(divs), GRAD_DIV_CLASS)
   lis = divs[0].find_all('li')
   items = []
-  for li in lis:
-    name = li.get_text().strip()
-    assert name != '', 'empty name in %s' % li
-    a = li.find_all('a')
-    assert len(a) == 1, 'found %d link in %s' % (len(a), li)
-    email = get_email(a[0])
-    items.append({'name': name, 'email': email, 'title': util.Title.GRAD})
-    counts['total'] += 1
-    counts['grad'] += 1
+  for i, li in enumerate(lis):
+    with util.quarantine(i, li):
+      name = li.get_text().strip()
+      assert name != '', 'empty name in %s' % li
+      a = li.find_all('a')
+      assert len(a) == 1, 'found %d link in %s' % (len(a), li)
+      email = get_email(a[0])
+      items.append({'name': name, 'email': email, 'title': util.Title.GRAD})
+      counts['total'] += 1
+      counts['grad'] += 1
   return items
 
-def process_postdoc(download_file):
-  soup = BeautifulSoup(open(download_file), 'html.parser')
+def process_postdoc(soup):
   uls = soup.find_all('ul', class_=POSTDOC_UL_CLASS)
   assert len(uls) == 1, 'found %d uls of class "%s"' % (
       len(uls), POSTDOC_UL_CLASS)
   lis = uls[0].find_all('li')
   items = []
-  for li in lis:
-    a = li.find_all('a')
-    assert len(a) == 1, 'found %d link in %s' % (len(a), li)
-    name = a[0].get_text().strip()
-    assert name != '', 'empty name in %s' % li
-    email = get_email(a[0])
-    items.append({'name': name, 'email': email, 'title': util.Title.POSTDOC})
-    counts['total'] += 1
-    counts['postdoc'] += 1
+  for i, li in enumerate(lis):
+    with util.quarantine(i, li):
+      a = li.find_all('a')
+      assert len(a) == 1, 'found %d link in %s' % (len(a), li)
+      name = a[0].get_text().strip()
+      assert name != '', 'empty name in %s' % li
+      email = get_email(a[0])
+      items.append(
+          {'name': name, 'email': email, 'title': util.Title.POSTDOC})
+      counts['total'] += 1
+      counts['postdoc'] += 1
   return items
 
-def get_title(position):
-  position = position.lower()
-  assert position in POSITION_TITLE_MAP, position
-  return POSITION_TITLE_MAP[position]
+def process_dir_rows(trs):
+  # trs iterates over the rows of the directory table, header first.
+  header = None
+  items = []
+  for i, tr in enumerate(trs):
+    if header is None:
+      header = tr.find_all('th')
+      # Name, position, office, ext, email (image).
+      assert len(header) == 5, 'expecting %d th, found %d' % (5, len(header))
+      continue
+    with util.quarantine(i, tr):
+      tds = tr.find_all('td')
+      assert len(tds) == 5, 'failed to parse %s' % tr
+      name = util.normalize_name(tds[0].get_text())
+      a = tds[0].find_all('a')
+      assert len(a) == 1, 'found %d link in %s' % (len(a), tds[0])
+      email = get_email(a[0])
+      title = TITLE_CLASSIFIER.classify(tds[1].get_text())
+      if title is None:
+        continue
+      item = {'name': name, 'email': email, 'title': title}
+      counts['total'] += 1
+      counts['dir'] += 1
+      items.append(item)
+  assert header is not None, 'empty directory table'
+  return items
 
-def process_dir(download_file):
-  soup = BeautifulSoup(open(download_file), 'html.parser')
-  tables = soup.find_all('table', class_=DIR_TABLE_CLASS)
+def process_dir(soup):
+  tables = soup.select(DIR_TABLE_SELECTOR)
+  assert len(tables) == 1, 'found %d tables matching "%s"' % (
+      len(tables), DIR_TABLE_SELECTOR)
+  return process_dir_rows(tables[0].find_all('tr'))
+
+def stream_dir(download_file):
+  tables = set()
+  def rows():
+    for table, tr in util.stream_rows(download_file, class_=DIR_TABLE_CLASS):
+      tables.add(table)
+      yield tr
+  items = process_dir_rows(rows())
   assert len(tables) == 1, 'found %d tables of class "%s"' % (
       len(tables), DIR_TABLE_CLASS)
-  trs = tables[0].find_all('tr')
-  assert len(trs) > 0
-  ths = trs[0].find_all('th')
-  # Name, position, office, ext, email (image).
-  assert len(ths) == 5, 'expecting %d th, found %d' % (5, len(ths))
-  items = []
-  for i in range(1, len(trs)):
-    tds = trs[i].find_all('td')
-    assert len(tds) == 5, 'failed to parse %s' % trs[i]
-    name = tds[0].get_text().strip()
-    last, first = name.split(', ')
-    name = '%s %s' % (first, last)
-    a = tds[0].find_all('a')
-    assert len(a) == 1, 'found %d link in %s' % (len(a), td)
-    email = get_email(a[0])
-    title = get_title(tds[1].get_text().strip())
-    if title is None:
-      continue
-    item = {'name': name, 'email': email, 'title': title}
-    counts['total'] += 1
-    counts['dir'] += 1
-    items.append(item)
   return items
 
-def process(download_file, key, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
+def parse(download_file, key):
   if key == 'grad':
-    items = process_grad(download_file)
+    extract, region = process_grad, GRAD_REGION
   elif key == 'postdoc':
-    items = process_postdoc(download_file)
+    extract, region = process_postdoc, POSTDOC_REGION
   elif key == 'dir':
-    items = process_dir(download_file)
+    return util.stream_with_fallback(
+        download_file, stream_dir, process_dir, counts, region=DIR_REGION)
   else:
     assert False, 'unrecognized key: %s' % key
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+  return util.parse_with_fallback(download_file, extract, counts,
+                                  region=region)
 
-def download_and_process(url, key, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, key, processed_dir)
-
-def main():
+def process(download_file, key, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
+
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, subdir, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
@@ -8,6 +7,10 @@ import phonenumbers
 import os
 import util
 
+SCHOOL = 'cmu'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 1
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'https://www.scs.cmu.edu/directory/all?term_node_tid_depth=All&page=': 'all'
@@ -37,8 +40,14 @@ POSITION_TITLE_LIST = [
       util.Title.STAFF],
 ]
 
-MIN_PAGE = 0
-MAX_PAGE = 36
+TITLE_CLASSIFIER = util.TitleClassifier(
+    POSITION_TITLE_LIST, util.TitleClassifier.CONTAINS, ignore_case=True)
+
+TABLE_SELECTOR = 'table.views-table.cols-6'
+# The part of each page the extraction looks at, parsed alone.
+TABLE_REGION = util.Region(TABLE_SELECTOR)
+
+FIRST_PAGE = 0
 # Download page 0 to page-1.html etc, to be consistent with other schools.
 OFFSET = 1
 
@@ -47,36 +56,13 @@ counts = {
     'email': 0,
 }
 
-def download(url, page, output_dir):
+def download_job(url, page, output_dir):
   url = '%s%d' % (url, page)
   output_file = '%s/page-%d.html' % (output_dir, page + OFFSET)
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
-def get_title(position):
-  position = position.lower()
-  for labels, title in POSITION_TITLE_LIST:
-    is_title = False
-    for label in labels:
-      if position.find(label) >= 0:
-        is_title = True
-        break
-    if is_title:
-      return title
-  # Not interested if position is not in existing map.
-  return None
-
-def process(afile, output_dir):
-  p = afile.rfind('/') + 1
-  assert p > 0
-  q = afile.rfind('.')
-  assert q > p
-  output_file = '%s/%s.txt' % (output_dir, afile[p:q])
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
+  return (url, output_file)
 
-  soup = BeautifulSoup(open(afile), 'html.parser')
-  tables = soup.find_all('table', class_='views-table cols-6')
+def process_table(soup, afile):
+  tables = soup.select(TABLE_SELECTOR)
   assert len(tables) == 1, 'expecting %d tables, got %d: %s' % (
       1, len(tables), afile)
   trs = tables[0].find_all('tr')
@@ -88,63 +74,83 @@ def process(afile, output_dir):
 
   items = []
   for i in range(1, len(trs)):
-    tds = trs[i].find_all('td')
-    assert len(tds) == len(header)
-
-    last = tds[0].get_text().strip()
-    assert last != ''
-    first = tds[1].get_text().strip()
-    assert first != ''
-    name = '%s %s' % (first, last)
-    title = get_title(tds[2].get_text().strip())
-    if title is None:
-      continue
-
-    user, domain = '', ''
-    uspans = tds[4].find_all('span', class_='u')
-    if len(uspans) > 0:
-      assert len(uspans) == 1, tds[4]
-      user = uspans[0].get_text().strip()
-    dspans = tds[4].find_all('span', class_='d')
-    if len(dspans) > 0:
-      assert len(dspans) == 1, tds[4]
-      domain = dspans[0].get_text().strip()
-    assert (user == '') == (domain == ''), tds[4]
-
-    item = {'name': name, 'title': title}
-    counts['total'] += 1
-    if user != '':
-      item['email'] = '%s@%s' % (user, domain)
-      counts['email'] += 1
-    items.append(item)
-
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
-
-def download_and_process(url, page, download_dir, processed_dir):
-  downloaded_file = download(url, page, download_dir)
-  processed_file = process(downloaded_file, processed_dir)
-  return [downloaded_file, processed_file]
-
-def main():
+    with util.quarantine(i, trs[i]):
+      tds = trs[i].find_all('td')
+      assert len(tds) == len(header)
+
+      last = tds[0].get_text().strip()
+      assert last != ''
+      first = tds[1].get_text().strip()
+      assert first != ''
+      name = '%s %s' % (first, last)
+      # Not interested if position matches no label.
+      title = TITLE_CLASSIFIER.classify(tds[2].get_text())
+      if title is None:
+        continue
+
+      user, domain = '', ''
+      uspans = tds[4].find_all('span', class_='u')
+      if len(uspans) > 0:
+        assert len(uspans) == 1, tds[4]
+        user = uspans[0].get_text().strip()
+      dspans = tds[4].find_all('span', class_='d')
+      if len(dspans) > 0:
+        assert len(dspans) == 1, tds[4]
+        domain = dspans[0].get_text().strip()
+      assert (user == '') == (domain == ''), tds[4]
+
+      item = {'name': name, 'title': title}
+      counts['total'] += 1
+      if user != '':
+        item['email'] = '%s@%s' % (user, domain)
+        counts['email'] += 1
+      items.append(item)
+  return items
+
+def is_empty_page(afile):
+  return len(util.make_soup(afile, region=TABLE_REGION).select(
+      TABLE_SELECTOR)) == 0
+
+def parse(afile):
+  return util.parse_with_fallback(
+      afile, lambda soup: process_table(soup, afile), counts,
+      region=TABLE_REGION)
+
+def process(afile, output_dir):
+  output_file = util.get_output_file(afile, output_dir)
+  if util.is_processed(afile, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      SCHOOL, PARSER_VERSION, afile, output_dir, lambda: parse(afile), counts)
+  util.write_items(output_file, items, SCHOOL, afile)
+
+def download_and_process(url, download_dir, processed_dir):
+  # The pager links to the last page; probe in case it is missing.
+  listing = util.Listing(
+      lambda page: download_job(url, page, download_dir), FIRST_PAGE,
+      util.get_max_page_param, is_empty_page)
+  def process_page(_, page, downloaded_file):
+    process(downloaded_file, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.fetch_listings([listing], util.OVERWRITE_DOWNLOAD,
+                        on_page=pipeline.feed(process_page))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
-
-  print '=================================================='
-  print 'WARNING: update MIN_PAGE and MAX_PAGE upon rerun!!'
-  print '=================================================='
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
   for url, subdir in URL_SUBDIR_MAP.iteritems():
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    page = MIN_PAGE
-    while page <= MAX_PAGE:
-      download_and_process(url, page, download_dir, processed_dir)
-      page += 1
+    download_and_process(url, download_dir, processed_dir)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
 import os
 import util
 
+SCHOOL = 'columbia'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 3
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'http://www.cs.columbia.edu/people/directory': 'all',
@@ -25,76 +28,113 @@ POSITION_TITLE_MAP = {
     'MS_student': util.Title.MASTER,
 }
 
+TITLE_CLASSIFIER = util.TitleClassifier(POSITION_TITLE_MAP)
+
 JS_PREFIX = 'hideemail('
 
 counts = {t: 0 for t in util.Title.ALL}
 for t in util.Title.ALL:
   counts['%s-email' % t] = 0
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
+def process_row(tr, title):
+  tds = tr.find_all('td')
+  assert len(tds) == 4, tr
+  name = util.normalize_name(tds[0].get_text())
+  email = ''
+  js = tds[2].find_all('script')
+  if len(js) > 0:
+    assert len(js) == 1, tr
+    js = js[0].get_text().strip()
+    assert js.startswith(JS_PREFIX)
+    _, user, domain, _, _ = js.split(',')
+    user = user.strip(" '\"")
+    domain = domain.strip(" '\"")
+    if user != '' and domain != '':
+      email = '%s@%s' % (user, domain)
+  item = {'name': name, 'title': title}
+  counts[title] += 1
+  if email != '':
+    item['email'] = email
+    counts['%s-email' % title] += 1
+  return item
 
-def process(download_file, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
-  soup = BeautifulSoup(open(download_file), 'html.parser')
+def get_table_title(table):
+  # Title of the named anchor closest before the table among its siblings,
+  # unless another table comes in between.  process_dir and stream_dir both
+  # assign rows to titles by it.
+  sibling = table.find_previous_sibling()
+  while sibling is not None and sibling.name != 'table':
+    if sibling.name == 'a' and 'name' in sibling.attrs:
+      return TITLE_CLASSIFIER.classify(sibling['name'])
+    sibling = sibling.find_previous_sibling()
+  return None
 
+def process_dir(soup):
   items = []
-  a = soup.find_all('a')
-  for aa in a:
-    if 'name' not in aa.attrs:
-      continue
-    title = POSITION_TITLE_MAP.get(aa['name'], None)
+  for table in soup.find_all('table'):
+    title = get_table_title(table)
     if title is None:
       continue
-    table = aa.findNextSibling('table')
     trs = table.find_all('tr')
-    for tr in trs:
-      tds = tr.find_all('td')
-      assert len(tds) == 4, tr
-      name = tds[0].get_text().strip()
-      last, first = name.split(', ')
-      name = '%s %s' % (first, last)
-      email = ''
-      js = tds[2].find_all('script')
-      if len(js) > 0:
-        assert len(js) == 1, tr
-        js = js[0].get_text().strip()
-        assert js.startswith(JS_PREFIX)
-        _, user, domain, _, _ = js.split(',')
-        user = user.strip(" '\"")
-        domain = domain.strip(" '\"")
-        if user != '' and domain != '':
-          email = '%s@%s' % (user, domain)
-      item = {'name': name, 'title': title}
-      counts[title] += 1
-      if email != '':
-        item['email'] = email
-        counts['%s-email' % title] += 1
-      items.append(item)
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
-
-def download_and_process(url, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, processed_dir)
-
-def main():
+    for i, tr in enumerate(trs):
+      with util.quarantine(i, tr):
+        items.append(process_row(tr, title))
+  return items
+
+def stream_dir(download_file):
+  items = []
+  current, title, i = None, None, 0
+  for table, tr in util.stream_rows(download_file):
+    if table != current:
+      current, title, i = table, get_table_title(table), 0
+    if title is not None:
+      with util.quarantine(i, tr):
+        items.append(process_row(tr, title))
+    i += 1
+  return items
+
+def parse(download_file):
+  return util.stream_with_fallback(
+      download_file, stream_dir, process_dir, counts)
+
+def process(download_file, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      SCHOOL, PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
+
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
@@ -8,6 +7,10 @@ import phonenumbers
 import os
 import util
 
+SCHOOL = 'stanford'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 1
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'http://www-cs.stanford.edu/directory/undergraduate-students':
@@ -21,8 +24,11 @@ URL_SUBDIR_MAP = {
     'http://www-cs.stanford.edu/directory/phd-alumni': util.Title.PHD_ALUMNI,
 }
 
+FIRST_PAGE = 1
 PAGE_COUNT_PREFIX = '<i>Page 1 of '
 PAGE_COUNT_SUFFIX = '</i>'
+# The part of each page the extraction looks at, parsed alone.
+TABLE_REGION = util.Region('table')
 
 counts = {
     util.Title.UNDERGRAD: 0,
@@ -33,24 +39,16 @@ counts = {
     util.Title.PHD_ALUMNI: 0,
 }
 
-def download(url, page, output_dir):
+def download_job(url, page, output_dir):
   output_file = '%s/page-%d.html' % (output_dir, page)
-  if os.path.isfile(output_file) and not util.OVERWRITE_DOWNLOAD:
-    print '%s exists and not overwritable' % output_file
-    return output_file
-
-  util.wait()
-  cmd = '%s --post-data page=%d %s -O %s -q' % (
-      util.WGET, page, url, output_file)
-  print 'running command: %s' % cmd
-  assert os.system(cmd) == 0
-  return output_file
+  return (url, output_file, 'page=%d' % page)
 
 def parse_page_count(afile):
-  with open(afile, 'r') as fp:
-    content = fp.read()
+  # None if the pager is missing, as for a single page.
+  content = util.read_download(afile)
   p = content.find(PAGE_COUNT_PREFIX)
-  assert p >= 0
+  if p < 0:
+    return None
   q = content.find(PAGE_COUNT_SUFFIX, p)
   assert q >= 0
   return int(content[p+len(PAGE_COUNT_PREFIX):q])
@@ -94,61 +92,74 @@ def count(items):
   for item in items:
     counts[item['title']] += 1
 
-def process(afile, title, output_dir):
-  p = afile.rfind('/') + 1
-  assert p > 0
-  q = afile.rfind('.')
-  assert q > p
-  output_file = '%s/%s.txt' % (output_dir, afile[p:q])
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
-
-  soup = BeautifulSoup(open(afile), 'html.parser')
+def process_table(soup, title):
   table = find_table(soup)
   rows = find_rows(soup)
 
   items = []
-  for row in rows:
-    cells = row.find_all('td')
-    assert len(cells) == 4, 'expecting %d cells, got %d: %s' % (
-        4, len(cells), cells)
-    name = cells[0].get_text().strip()
-    email = cells[3].get_text().strip()
-
-    assert name != '', 'missing name: %s' % row
-    item = {'name': name, 'title': title}
-    if email != '':
-      item['email'] = sanitize_email(email)
-    items.append(item)
+  for i, row in enumerate(rows):
+    with util.quarantine(i, row):
+      cells = row.find_all('td')
+      assert len(cells) == 4, 'expecting %d cells, got %d: %s' % (
+          4, len(cells), cells)
+      name = cells[0].get_text().strip()
+      email = cells[3].get_text().strip()
+
+      assert name != '', 'missing name: %s' % row
+      item = {'name': name, 'title': title}
+      if email != '':
+        item['email'] = sanitize_email(email)
+      items.append(item)
   count(items)
+  return items
 
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
-
-def download_and_process(url, title, page, download_dir, processed_dir):
-  downloaded_file = download(url, page, download_dir)
-  processed_file = process(downloaded_file, title, processed_dir)
-  return [downloaded_file, processed_file]
+def parse(afile, title):
+  return util.parse_with_fallback(
+      afile, lambda soup: process_table(soup, title), counts,
+      region=TABLE_REGION)
 
-def main():
+def process(afile, title, output_dir):
+  output_file = util.get_output_file(afile, output_dir)
+  if util.is_processed(afile, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, title), PARSER_VERSION, afile, output_dir,
+      lambda: parse(afile, title), counts)
+  util.write_items(output_file, items, SCHOOL, afile)
+
+def get_listing(url, download_dir):
+  return util.Listing(lambda page: download_job(url, page, download_dir),
+                      FIRST_PAGE, parse_page_count)
+
+def download_and_process(jobs):
+  listings = [get_listing(url, download_dir)
+              for url, _, download_dir, _ in jobs]
+  def process_page(listing, page, downloaded_file):
+    url, title, _, processed_dir = jobs[listings.index(listing)]
+    print 'processing %s => %s (page %d)' % (url, title, page)
+    process(downloaded_file, title, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.fetch_listings(listings, util.OVERWRITE_DOWNLOAD,
+                        on_page=pipeline.feed(process_page))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    downloaded_file, _ = download_and_process(
-        url, subdir, 1, download_dir, processed_dir)
-    page_count = parse_page_count(downloaded_file)
-    print 'page count: %d' % page_count
-    for i in range(2, page_count + 1):
-      download_and_process(url, subdir, i, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
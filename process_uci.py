@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
@@ -8,72 +7,91 @@ import os
 import urllib
 import util
 
+SCHOOL = 'uci'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 1
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'http://www.ics.uci.edu/about/search/search_graduate_all.php':
         util.Title.GRAD,
 }
 HREF_EMAIL_PREFIX = 'mailto:'
+# The part of each page the extraction looks at, parsed alone.
+TABLE_REGION = util.Region('table')
 
 counts = {
     'total': 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
-def process_grad(download_file):
-  # Use lxml to be lenient; the html table is malformed.
-  soup = BeautifulSoup(open(download_file), 'lxml')
+def process_grad(soup, download_file):
   tables = soup.find_all('table')
   assert len(tables) == 1, 'expecting %d tables, got %d: %s' % (
       1, len(tables), download_file)
   trs = tables[0].find_all('tr')
   items = []
-  for tr in trs:
-    tds = tr.find_all('td')
-    assert len(tds) == 1
-    name = tds[0].get_text().strip()
-    p = name.find('|')
-    if p > 0:
-      assert name[p+1:].strip() == 'Website', tds[0]
-      name = name[:p].strip()
-    a = tds[0].find_all('a')
-    assert len(a) > 0
-    assert a[0]['href'].startswith(HREF_EMAIL_PREFIX)
-    email = urllib.unquote(a[0]['href'][len(HREF_EMAIL_PREFIX):]).strip()
-    item = {'name': name, 'email': email, 'title': util.Title.GRAD}
-    counts['total'] += 1
-    items.append(item)
+  for i, tr in enumerate(trs):
+    with util.quarantine(i, tr):
+      tds = tr.find_all('td')
+      assert len(tds) == 1
+      name = tds[0].get_text().strip()
+      p = name.find('|')
+      if p > 0:
+        assert name[p+1:].strip() == 'Website', tds[0]
+        name = name[:p].strip()
+      a = tds[0].find_all('a')
+      assert len(a) > 0
+      assert a[0]['href'].startswith(HREF_EMAIL_PREFIX)
+      email = urllib.unquote(a[0]['href'][len(HREF_EMAIL_PREFIX):]).strip()
+      item = {'name': name, 'email': email, 'title': util.Title.GRAD}
+      counts['total'] += 1
+      items.append(item)
   return items
 
+def parse(download_file):
+  # Fall back to lxml to be lenient; the html table is malformed.
+  return util.parse_with_fallback(
+      download_file, lambda soup: process_grad(soup, download_file), counts,
+      fallback='bs4-lxml', region=TABLE_REGION)
+
 def process(download_file, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
     return output_file
-  items = process_grad(download_file)
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+  items = util.cached_parse(
+      SCHOOL, PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
 
-def download_and_process(url, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, processed_dir)
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
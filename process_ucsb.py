@@ -1,18 +1,39 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
-from validate_email import validate_email
-
 import argparse
 import os
 import util
 
+SCHOOL = 'ucsb'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 2
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'https://www.cs.ucsb.edu/people/grad': util.Title.GRAD,
     'https://www.cs.ucsb.edu/people/alumni': util.Title.GRAD_ALUMNI,
 }
 
+TABLE_SELECTOR = 'table.views-table.cols-6'
+# The part of each page the extraction looks at, parsed alone.
+TABLE_REGION = util.Region(TABLE_SELECTOR)
+
+DEGREE_TITLE_LIST = [
+    [['Ph.D.'], util.Title.PHD],
+    [['M.S.'], util.Title.MASTER],
+    [['B.S.'], util.Title.UNDERGRAD],
+]
+ALUMNI_DEGREE_TITLE_LIST = [
+    [['Ph.D.'], util.Title.PHD_ALUMNI],
+    [['M.S.'], util.Title.MASTER_ALUMNI],
+    [['B.S.'], util.Title.UNDERGRAD_ALUMNI],
+]
+
+TITLE_CLASSIFIER = util.TitleClassifier(DEGREE_TITLE_LIST, strict=True)
+# Alumni list all their degrees, comma separated; the highest wins.
+ALUMNI_TITLE_CLASSIFIER = util.TitleClassifier(
+    ALUMNI_DEGREE_TITLE_LIST, util.TitleClassifier.ITEM, strict=True)
+
 counts = {
     util.Title.UNDERGRAD: 0,
     util.Title.MASTER: 0,
@@ -22,13 +43,8 @@ counts = {
     util.Title.PHD_ALUMNI: 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
-def parse_table(download_file):
-  soup = BeautifulSoup(open(download_file), 'html.parser')
-  tables = soup.find_all('table', class_='views-table cols-6')
+def parse_table(soup, download_file):
+  tables = soup.select(TABLE_SELECTOR)
   assert len(tables) == 1, 'expecting %d tables, found %d: %s' % (
       1, len(tables), download_file)
   trs = tables[0].find_all('tr')
@@ -40,26 +56,22 @@ def parse_table(download_file):
     rows.append(trs[i].find_all('td'))
   return header, rows
 
+def check_rows(header, rows):
+  # (index, row) for the rows with a cell per column, quarantining the others.
+  checked = []
+  for i, row in enumerate(rows, 1):
+    with util.quarantine(i, row):
+      assert len(row) == len(header), 'bad row: %s' % row
+      checked.append((i, row))
+  return checked
+
 def get_title(position, is_alumni):
   if is_alumni:
-    items = set([item.strip() for item in position.split(',')])
-    if 'Ph.D.' in items:
-      return util.Title.PHD_ALUMNI
-    if 'M.S.' in items:
-      return util.Title.MASTER_ALUMNI
-    if 'B.S.' in items:
-      return util.Title.UNDERGRAD_ALUMNI
-    assert False, position
-  if position == 'Ph.D.':
-    return util.Title.PHD
-  if position == 'M.S.':
-    return util.Title.MASTER
-  if position == 'B.S.':
-    return util.Title.UNDERGRAD
-  assert False, position
-
-def process_grad(download_file):
-  header, rows = parse_table(download_file)
+    return ALUMNI_TITLE_CLASSIFIER.classify(position)
+  return TITLE_CLASSIFIER.classify(position)
+
+def process_grad(soup, download_file):
+  header, rows = parse_table(soup, download_file)
   assert header == [
       'Name',
       'Academic Level',
@@ -67,24 +79,23 @@ def process_grad(download_file):
       'Email',
       'Office',
       'Website'], 'unexpected header: %s' % header
+  rows = check_rows(header, rows)
+  emails = util.clean_emails([row[3].get_text() for _, row in rows])
   items = []
-  for row in rows:
-    assert len(row) == len(header), 'bad row: %s' % row
-    name = row[0].get_text().strip()
-    assert name != ''
-    title = get_title(row[1].get_text().strip(), False)
-    email = row[3].get_text().strip()
-    if not validate_email(email):
-      email = ''
-    item = {'name': name, 'title': title}
-    counts[title] += 1
-    if email != '':
-      item['email'] = email
-    items.append(item)
+  for (i, row), email in zip(rows, emails):
+    with util.quarantine(i, row):
+      name = row[0].get_text().strip()
+      assert name != ''
+      title = get_title(row[1].get_text().strip(), False)
+      item = {'name': name, 'title': title}
+      counts[title] += 1
+      if email is not None:
+        item['email'] = email
+      items.append(item)
   return items
 
-def process_alumni(download_file):
-  header, rows = parse_table(download_file)
+def process_alumni(soup, download_file):
+  header, rows = parse_table(soup, download_file)
   assert header == [
       'Name',
       'Degree',
@@ -92,53 +103,70 @@ def process_alumni(download_file):
       'Email',
       'Employer',
       'Website'], 'unexpected header: %s' % header
+  rows = check_rows(header, rows)
+  emails = util.clean_emails([row[3].get_text() for _, row in rows])
   items = []
-  for row in rows:
-    assert len(row) == len(header), 'bad row: %s' % row
-    name = row[0].get_text().strip()
-    assert name != ''
-    title = get_title(row[1].get_text().strip(), True)
-    email = row[3].get_text().strip()
-    if not validate_email(email):
-      email = ''
-    item = {'name': name, 'title': title}
-    counts[title] += 1
-    if email != '':
-      item['email'] = email
-    items.append(item)
+  for (i, row), email in zip(rows, emails):
+    with util.quarantine(i, row):
+      name = row[0].get_text().strip()
+      assert name != ''
+      title = get_title(row[1].get_text().strip(), True)
+      item = {'name': name, 'title': title}
+      counts[title] += 1
+      if email is not None:
+        item['email'] = email
+      items.append(item)
   return items
 
-def process(download_file, key, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
+def parse(download_file, key):
   if key == util.Title.GRAD:
-    items = process_grad(download_file)
+    extract = process_grad
   elif key == util.Title.GRAD_ALUMNI:
-    items = process_alumni(download_file)
+    extract = process_alumni
   else:
     assert False, 'unrecognized key: %s' % key
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+  return util.parse_with_fallback(
+      download_file, lambda soup: extract(soup, download_file), counts,
+      region=TABLE_REGION)
+
+def process(download_file, key, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
 
-def download_and_process(url, key, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, key, processed_dir)
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, subdir, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
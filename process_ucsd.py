@@ -1,16 +1,12 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
-from validate_email import validate_email
-
 import argparse
 import os
 import util
 
-# Should always be true because url processing order may be different
-# everytime (iterating through URL_SUBDIR_MAP).  TODO: fix this.
-OVERWRITE_DOWNLOAD = True
-OVERWRITE_PROCESSED = True
+SCHOOL = 'ucsd'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 3
 
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
@@ -32,12 +28,17 @@ URL_SUBDIR_MAP = {
     'http://www.cse.ucsd.edu/node/182': 'phd',
 }
 
+DIR_TABLE_CLASS = 'searchTbl'
 DIR_SECTION = 'Researchers/Post-Docs/Visitors'
 PHD_TITLE_PREFIX = 'Graduating PhDs in '
 HREF_EMAIL_PREFIX = 'mailto:'
 WEB_TEXT = 'home page'
 EMAIL_PREFIX = 'Email:'
 
+# The part of each page the extraction looks at, parsed alone.
+DIR_REGION = util.Region('table.%s' % DIR_TABLE_CLASS)
+PHD_REGION = util.Region('div.content')
+
 counts = {
     'dir': 0,
     'dir-email': 0,
@@ -45,10 +46,6 @@ counts = {
     'phd-email': 0,
 }
 
-def download(url, download_dir, page):
-  output_file = '%s/page-%d.html' % (download_dir, page)
-  return util.download(url, output_file, OVERWRITE_DOWNLOAD)
-
 def validate_dir_header(tr):
   ths = tr.find_all('th')
   assert len(ths) == 6, 'expecting %d columns, got %d: %s' % (
@@ -60,21 +57,40 @@ def validate_dir_header(tr):
   assert ths[4].get_text().strip() == 'Email'
   assert ths[5].get_text().strip() == 'Mail'
 
+def is_section(tr, section=None):
+  if 'bgcolor' not in tr.attrs or tr['bgcolor'] != '#FFFF99':
+    return False
+  return section is None or tr.get_text().strip() == section
+
 def find_section(trs, section=None, start=0):
   for i in range(start, len(trs)):
-    if 'bgcolor' not in trs[i].attrs or trs[i]['bgcolor'] != '#FFFF99':
-      continue
-    if section is None:
-      return i
-    text = trs[i].get_text().strip()
-    if text == section:
+    if is_section(trs[i], section):
       return i
   return -1
 
-def process_dir(download_file):
-  # To be lenient.  Html table is malformed.
-  soup = BeautifulSoup(open(download_file), 'lxml')
-  tables = soup.find_all('table', class_='searchTbl')
+def process_dir_row(tr):
+  tds = tr.find_all('td')
+  assert len(tds) == 6, 'expecting %d columns, got %d: %s' % (
+      6, len(tds), tr)
+  name = util.normalize_name(tds[0].get_text())
+  email = tds[4].get_text().strip()
+  assert email != ''
+  a = tds[4].find_all('a')
+  # TODO: handle multiple emails.
+  if len(a) == 1:
+    assert a[0]['href'] == 'mailto:%s' % email, (
+        'expecting mailto:%s, got %s: %s' % (email, a[0]['href'], tr))
+  else:
+    email = ''
+  item = {'name': name, 'title': util.Title.STAFF}
+  counts['dir'] += 1
+  if email != '':
+    item['email'] = email
+    counts['dir-email'] += 1
+  return item
+
+def process_dir(soup, download_file):
+  tables = soup.find_all('table', class_=DIR_TABLE_CLASS)
   assert len(tables) == 2, 'expecting %d tables, got %d: %s' % (
       2, len(tables), download_file)
   trs = tables[1].find_all('tr')
@@ -90,28 +106,33 @@ def process_dir(download_file):
 
   items = []
   for i in range(start, end):
-    tds = trs[i].find_all('td')
-    assert len(tds) == 6, 'expecting %d columns, got %d: %s' % (
-        6, len(tds), trs[i])
-    name = tds[0].get_text().strip()
-    last, first = name.split(', ')
-    name = '%s %s' % (first, last)
-    email = tds[4].get_text().strip()
-    assert email != ''
-    a = tds[4].find_all('a')
-    # TODO: handle multiple emails.
-    if len(a) == 1:
-      assert a[0]['href'] == 'mailto:%s' % email, (
-          'expecting mailto:%s, got %s: %s' % (
-              email, a[0]['href'], trs[i]))
+    with util.quarantine(i, trs[i]):
+      items.append(process_dir_row(trs[i]))
+  return items
+
+def stream_dir(download_file):
+  # Same as process_dir, but reads the table one row at a time and stops at
+  # the end of the section.  Does not check the number of tables.
+  is_header = True
+  in_section = False
+  items = []
+  for i, (_, tr) in enumerate(util.stream_rows(
+      download_file, class_=DIR_TABLE_CLASS, index=1)):
+    if is_header:
+      validate_dir_header(tr)
+      is_header = False
+    elif not in_section:
+      in_section = is_section(tr, section=DIR_SECTION)
+    elif is_section(tr):
+      break
     else:
-      email = ''
-    item = {'name': name, 'title': util.Title.STAFF}
-    counts['dir'] += 1
-    if email != '':
-      item['email'] = email
-      counts['dir-email'] += 1
-    items.append(item)
+      with util.quarantine(i, tr):
+        items.append(process_dir_row(tr))
+  else:
+    assert in_section, 'could not find section %s: %s' % (
+        DIR_SECTION, download_file)
+    assert False, 'could not find end of section: %s' % download_file
+  assert len(items) > 0, 'could not find end of section: %s' % download_file
   return items
 
 def get_email(raw):
@@ -123,9 +144,7 @@ def get_email(raw):
     if part == 'dot':
       part = '.'
     email += part
-  if validate_email(email):
-    return email
-  return None
+  return util.clean_email(email)
 
 def process_phd_content(raw_lines):
   lines = []
@@ -152,9 +171,8 @@ def process_phd_content(raw_lines):
     index += 1
     while index < len(lines):
       p = lines[index].find('@')
-      if p >= 0 and validate_email('x%s' % lines[index][p:]):
-        if validate_email(lines[index]):
-          email = lines[index]
+      if p >= 0 and util.is_email_domain(lines[index][p+1:]):
+        email = util.clean_email(lines[index])
         break
       if lines[index] == EMAIL_PREFIX:
         index += 1
@@ -189,9 +207,7 @@ def process_phd_content(raw_lines):
     index += 1
   return items
 
-def process_phd(download_file):
-  soup = BeautifulSoup(open(download_file), 'html.parser')
-
+def process_phd(soup, download_file):
   # Get graduating year.
   #h1 = soup.find_all('h1', class_='title')
   #assert len(h1) == 1, 'expecting %d title, found %d: %s' % (
@@ -214,38 +230,57 @@ def process_phd(download_file):
 
   return items
 
-def process(download_file, key, processed_dir, page):
-  output_file = '%s/page-%d.txt' % (processed_dir, page)
-  if os.path.isfile(output_file) and not OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
+def parse(download_file, key):
   if key == 'dir':
-    items = process_dir(download_file)
-  elif key == 'phd':
-    items = process_phd(download_file)
-  else:
-    assert False, 'unknown key: %s' % key
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+    # Fall back to lxml to be lenient.  Html table is malformed.
+    return util.stream_with_fallback(
+        download_file, stream_dir,
+        lambda soup: process_dir(soup, download_file), counts,
+        fallback='bs4-lxml', region=DIR_REGION)
+  if key == 'phd':
+    return util.parse_with_fallback(
+        download_file, lambda soup: process_phd(soup, download_file), counts,
+        region=PHD_REGION)
+  assert False, 'unknown key: %s' % key
+
+def process(download_file, key, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
 
-def download_and_process(url, key, download_dir, processed_dir, page_counts):
-  page_counts[key] += 1
-  download_file = download(url, download_dir, page_counts[key])
-  process(download_file, key, processed_dir, page_counts[key])
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
-  page_counts = {subdir: 0 for subdir in set(URL_SUBDIR_MAP.values())}
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, subdir, download_dir, processed_dir, page_counts)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
 import os
 import util
 
+SCHOOL = 'umass'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 2
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'https://www.cics.umass.edu/people/graduate-students': 'grad',
@@ -16,31 +19,28 @@ URL_SUBDIR_MAP = {
      '?field_graduation_year_value=All&page='): 'master',
 }
 
-PAGE_MAP = {
+# First page of paginated urls, None for single-page ones.
+FIRST_PAGE_MAP = {
     'grad': None,
-    'phd': 8,
-    'master': 3
+    'phd': 0,
+    'master': 0,
 }
 
+# The part of each page the extraction looks at, parsed alone.
+GRAD_REGION = util.Region('table')
+PANEL_REGION = util.Region('div.group-person-info-panel')
+
 counts = {
     'grad': 0,
     'phd': 0,
     'master': 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
-
-def download_page(url, page, download_dir):
-  output_file = '%s/page-%d.html' % (download_dir, page+1)
-  return util.download('%s%d' % (url, page), output_file, util.OVERWRITE_DOWNLOAD)
-
-def get_name(text):
-  if text.find(',') < 0:
-    return text
-  last, first = text.split(', ')
-  return '%s %s' % (first, last)
+def download_job(url, page, download_dir):
+  # page is None for single-page urls.
+  if page is None:
+    return (url, '%s/page-1.html' % download_dir)
+  return ('%s%d' % (url, page), '%s/page-%d.html' % (download_dir, page+1))
 
 def process_grad(soup):
   tables = soup.find_all('table')
@@ -51,19 +51,20 @@ def process_grad(soup):
       'Name', 'Phone', 'E-Mail (@cs.umass.edu)']
   items = []
   for i in range(1, len(trs)):
-    ths = trs[i].find_all('th')
-    assert len(ths) == 3, trs[i]
-    name = get_name(ths[0].get_text().strip())
-    assert name != ''
-    user = ths[2].get_text().strip()
-    email = ''
-    if user != '':
-      email = '%s@cs.umass.edu' % user
-    item = {'name': name, 'title': util.Title.GRAD}
-    if email != '':
-      item['email'] = email
-    items.append(item)
-    counts['grad'] += 1
+    with util.quarantine(i, trs[i]):
+      ths = trs[i].find_all('th')
+      assert len(ths) == 3, trs[i]
+      name = util.normalize_name(ths[0].get_text())
+      assert name != ''
+      user = ths[2].get_text().strip()
+      email = ''
+      if user != '':
+        email = '%s@cs.umass.edu' % user
+      item = {'name': name, 'title': util.Title.GRAD}
+      if email != '':
+        item['email'] = email
+      items.append(item)
+      counts['grad'] += 1
   return items
 
 EMAIL_PREFIX = 'mailto:'
@@ -78,64 +79,82 @@ def get_email(a):
 def process_phd_master(soup, title):
   divs = soup.find_all('div', class_='group-person-info-panel')
   items = []
-  for div in divs:
-    h2s = div.find_all('h2')
-    assert len(h2s) == 1, div
-    name = get_name(h2s[0].get_text().strip())
-    email = get_email(div.find_all('a'))
-    item = {'name': name, 'title': title}
-    if email != '':
-      item['email'] = email
-    items.append(item)
-    counts[title] += 1
+  for i, div in enumerate(divs):
+    with util.quarantine(i, div):
+      h2s = div.find_all('h2')
+      assert len(h2s) == 1, div
+      name = util.normalize_name(h2s[0].get_text())
+      email = get_email(div.find_all('a'))
+      item = {'name': name, 'title': title}
+      if email != '':
+        item['email'] = email
+      items.append(item)
+      counts[title] += 1
   return items
 
-def process(download_file, key, processed_dir):
-  p = download_file.rfind('/')
-  q = download_file.rfind('.')
-  output_file = '%s/%s.txt' % (processed_dir, download_file[p+1:q])
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
-    return output_file
-  soup = BeautifulSoup(open(download_file), 'html.parser')
+def is_empty_page(download_file):
+  soup = util.make_soup(download_file, region=PANEL_REGION)
+  return len(soup.find_all('div', class_='group-person-info-panel')) == 0
+
+def parse(download_file, key):
+  region = PANEL_REGION
   if key == 'grad':
-    items = process_grad(soup)
+    extract, region = process_grad, GRAD_REGION
   elif key == 'phd':
-    items = process_phd_master(soup, util.Title.PHD)
+    extract = lambda soup: process_phd_master(soup, util.Title.PHD)
   else:
     assert key == 'master', key
-    items = process_phd_master(soup, util.Title.MASTER)
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
-
-def download_and_process(url, key, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, key, processed_dir)
+    extract = lambda soup: process_phd_master(soup, util.Title.MASTER)
+  return util.parse_with_fallback(download_file, extract, counts,
+                                  region=region)
 
-def main():
+def process(download_file, key, processed_dir):
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
+    return output_file
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
+
+def get_listing(url, first_page, download_dir):
+  make_job = lambda page: download_job(url, page, download_dir)
+  if first_page is None:
+    return util.Listing(make_job, None, lambda download_file: None)
+  # The pager links to the last page; probe in case it is missing.
+  return util.Listing(
+      make_job, first_page, util.get_max_page_param, is_empty_page)
+
+def download_and_process(jobs):
+  listings = [get_listing(url, first_page, download_dir)
+              for url, _, first_page, download_dir, _ in jobs]
+  def process_page(listing, page, download_file):
+    _, key, _, _, processed_dir = jobs[listings.index(listing)]
+    print 'processing %s => %s' % (listing.make_job(page)[0], key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.fetch_listings(listings, util.OVERWRITE_DOWNLOAD,
+                        on_page=pipeline.feed(process_page))
+
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
-
-  print '================================================================'
-  print 'WARNING: update page counts for graduating phd/master students!!'
-  print '================================================================'
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    pages = PAGE_MAP[subdir]
-    if pages is None:
-      download_file = download(url, download_dir)
-      process(download_file, subdir, processed_dir)
-    else:
-      for i in range(pages):
-        download_file = download_page(url, i, download_dir)
-        process(download_file, subdir, processed_dir)
+    jobs.append(
+        (url, subdir, FIRST_PAGE_MAP[subdir], download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
-from bs4 import BeautifulSoup
 from validate_email import validate_email
 
 import argparse
 import os
 import util
 
+SCHOOL = 'wisc'
+# Bump whenever extraction changes, to invalidate cached parse results.
+PARSER_VERSION = 1
+
 # Url to subdir mapping.
 URL_SUBDIR_MAP = {
     'https://www.cs.wisc.edu/people/graduate-students': util.Title.GRAD,
@@ -16,62 +19,81 @@ URL_SUBDIR_MAP = {
 LI_CLASS = 'views-row'
 NAME_DIV_CLASS = 'views-field-field-full-name'
 EMAIL_DIV_CLASS = 'views-field-views-conditional'
+# The part of each page the extraction looks at, parsed alone.
+LIST_REGION = util.Region('li.%s' % LI_CLASS)
 
 counts = {
     util.Title.GRAD: 0,
     util.Title.UNDERGRAD: 0,
 }
 
-def download(url, download_dir):
-  output_file = '%s/page-1.html' % download_dir
-  return util.download(url, output_file, util.OVERWRITE_DOWNLOAD)
+def process_list(soup, key):
+  lis = soup.find_all('li', class_=LI_CLASS)
+  items = []
+  for i, li in enumerate(lis):
+    with util.quarantine(i, li):
+      divs = li.find_all('div', class_=NAME_DIV_CLASS)
+      assert len(divs) == 1, li
+      name = divs[0].get_text().strip()
+      assert name != '', li
+      divs = li.find_all('div', class_=EMAIL_DIV_CLASS)
+      assert len(divs) == 1, li
+      a = divs[0].find_all('a')
+      email = ''
+      if len(a) > 0:
+        assert len(a) == 1, li
+        email = a[0].get_text().strip()
+        assert a[0]['href'].strip() == 'mailto:%s' % email, li
+      item = {'name': name, 'title': key}
+      counts[key] += 1
+      if email != '':
+        item['email'] = email
+      items.append(item)
+  return items
+
+def parse(download_file, key):
+  return util.parse_with_fallback(
+      download_file, lambda soup: process_list(soup, key), counts,
+      region=LIST_REGION)
 
 def process(download_file, key, processed_dir):
-  output_file = '%s/page-1.txt' % processed_dir
-  if os.path.isfile(output_file) and not util.OVERWRITE_PROCESSED:
-    print '%s exists and not overwritable' % output_file
+  output_file = util.get_output_file(download_file, processed_dir)
+  if util.is_processed(download_file, output_file, util.OVERWRITE_PROCESSED,
+                       counts):
+    print '%s is up to date' % output_file
     return output_file
-  soup = BeautifulSoup(open(download_file), 'html.parser')
-  lis = soup.find_all('li', class_=LI_CLASS)
-  items = []
-  for li in lis:
-    divs = li.find_all('div', class_=NAME_DIV_CLASS)
-    assert len(divs) == 1, li
-    name = divs[0].get_text().strip()
-    assert name != '', li
-    divs = li.find_all('div', class_=EMAIL_DIV_CLASS)
-    assert len(divs) == 1, li
-    a = divs[0].find_all('a')
-    email = ''
-    if len(a) > 0:
-      assert len(a) == 1, li
-      email = a[0].get_text().strip()
-      assert a[0]['href'].strip() == 'mailto:%s' % email, li
-    item = {'name': name, 'title': key}
-    counts[key] += 1
-    if email != '':
-      item['email'] = email
-    items.append(item)
-  with open(output_file, 'w') as fp:
-    for item in items:
-      print >> fp, item
+  items = util.cached_parse(
+      '%s/%s' % (SCHOOL, key), PARSER_VERSION, download_file, processed_dir,
+      lambda: parse(download_file, key), counts)
+  util.write_items(output_file, items, SCHOOL, download_file)
 
-def download_and_process(url, key, download_dir, processed_dir):
-  download_file = download(url, download_dir)
-  process(download_file, key, processed_dir)
+def download_and_process(jobs):
+  def process_job(i, download_file):
+    url, key, _, processed_dir = jobs[i]
+    print 'processing %s => %s' % (url, key)
+    process(download_file, key, processed_dir)
+  with util.Pipeline() as pipeline:
+    util.download_all(
+        [(url, util.get_download_file(download_dir, url))
+         for url, _, download_dir, _ in jobs], util.OVERWRITE_DOWNLOAD,
+        pipeline.feed(process_job))
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument('--download_dir', required=True)
   parser.add_argument('--processed_dir', required=True)
-  args = parser.parse_args()
+  util.add_common_args(parser)
+  args = parser.parse_args(argv)
+  util.init(args, SCHOOL)
 
   util.prepare_dirs(URL_SUBDIR_MAP, args.download_dir, args.processed_dir)
+  jobs = []
   for url, subdir in URL_SUBDIR_MAP.iteritems():
-    print 'processing %s => %s' % (url, subdir)
     download_dir = '%s/%s' % (args.download_dir, subdir)
     processed_dir = '%s/%s' % (args.processed_dir, subdir)
-    download_and_process(url, subdir, download_dir, processed_dir)
+    jobs.append((url, subdir, download_dir, processed_dir))
+  download_and_process(jobs)
+  util.finish()
   print counts
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import argparse
+import glob
+import importlib
+import multiprocessing
+import os
+import people_index
+import sys
+import time
+import traceback
+import util
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_PREFIX = 'process_'
+
+def discover_schools():
+  schools = []
+  for path in sorted(glob.glob('%s/%s*.py' % (SCRIPT_DIR, MODULE_PREFIX))):
+    name = os.path.basename(path)[:-len('.py')]
+    schools.append(name[len(MODULE_PREFIX):])
+  return schools
+
+def init_worker(slots):
+  # Downloads of all schools share one global concurrency budget.  Per-host
+  # budgets stay per process since no two schools crawl the same host.
+  util.shared_slots = slots
+
+def run_school(job):
+  school, argv, log_file = job
+  start = time.time()
+  stdout = sys.stdout
+  try:
+    with open(log_file, 'w') as fp:
+      sys.stdout = fp
+      try:
+        module = importlib.import_module('%s%s' % (MODULE_PREFIX, school))
+        module.main(argv)
+      finally:
+        sys.stdout = stdout
+    return (school, time.time() - start, module.counts,
+            len(util.quarantined), len(util.failed_downloads), None)
+  except BaseException:
+    return school, time.time() - start, None, 0, 0, traceback.format_exc()
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Runs all process_*.py scrapers; unrecognized flags are '
+      'passed through to every scraper.')
+  parser.add_argument('--data_dir', required=True,
+                      help='uses <data_dir>/<school>/{download,processed}')
+  parser.add_argument('--schools', default=None,
+                      help='comma separated subset of schools to run')
+  parser.add_argument('--processes', type=int,
+                      default=multiprocessing.cpu_count())
+  parser.add_argument('--max_workers', type=int, default=util.MAX_WORKERS,
+                      help='downloads in flight across all schools')
+  parser.add_argument('--output_format', choices=util.OUTPUT_FORMATS.keys(),
+                      default=util.OUTPUT_FORMAT)
+  parser.add_argument('--index_file', default=None,
+                      help='people index to rebuild from the schools run, see '
+                      'people_index.py')
+  parser.add_argument('--metrics_dir', default=None,
+                      help='directory to write the metrics of each school to, '
+                      'as <school>.prom or <school>.json')
+  parser.add_argument('--metrics_format', choices=util.METRICS_FORMATS.keys(),
+                      default=util.METRICS_FORMAT)
+  parser.add_argument('--merged_output', default=None,
+                      help='parquet file to write the records of all schools '
+                      'to, requires pyarrow')
+  args, school_args = parser.parse_known_args()
+
+  schools = discover_schools()
+  if args.schools is not None:
+    selected = args.schools.split(',')
+    for school in selected:
+      assert school in schools, 'unknown school: %s' % school
+    schools = selected
+
+  jobs = []
+  for school in schools:
+    school_dir = '%s/%s' % (args.data_dir, school)
+    if not os.path.isdir(school_dir):
+      os.makedirs(school_dir)
+    argv = ['--download_dir=%s/download' % school_dir,
+            '--processed_dir=%s/processed' % school_dir,
+            '--output_format=%s' % args.output_format] + school_args
+    if args.metrics_dir is not None:
+      argv += ['--metrics_file=%s/%s.%s' % (
+                   args.metrics_dir, school,
+                   util.METRICS_FORMATS[args.metrics_format]),
+               '--metrics_format=%s' % args.metrics_format]
+    jobs.append((school, argv, '%s/run.log' % school_dir))
+
+  start = time.time()
+  slots = multiprocessing.BoundedSemaphore(args.max_workers)
+  pool = multiprocessing.Pool(
+      min(args.processes, len(jobs)), init_worker, (slots,))
+  failed = []
+  try:
+    for (school, secs, counts, quarantined, failed_downloads,
+         error) in pool.imap_unordered(run_school, jobs):
+      if error is not None:
+        failed.append(school)
+        print '%-12s FAILED after %.1fs (see %s/%s/run.log)\n%s' % (
+            school, secs, args.data_dir, school, error)
+      else:
+        print '%-12s %6.1fs %s' % (school, secs, counts)
+        if quarantined:
+          print '%-12s %d rows quarantined (see %s/%s/processed/%s)' % (
+              '', quarantined, args.data_dir, school, util.ERRORS_FILENAME)
+        if failed_downloads:
+          print '%-12s %d downloads failed (see %s/%s/run.log)' % (
+              '', failed_downloads, args.data_dir, school)
+  finally:
+    pool.close()
+    pool.join()
+  print 'ran %d schools in %.1fs, %d failed: %s' % (
+      len(jobs), time.time() - start, len(failed), ','.join(sorted(failed)))
+  output_files = []
+  for school in schools:
+    if school not in failed:
+      output_files.extend(util.find_output_files(
+          '%s/%s/processed' % (args.data_dir, school), args.output_format))
+  if args.merged_output is not None:
+    rows = util.merge_items(output_files, args.merged_output)
+    print 'merged %d records from %d files into %s' % (
+        rows, len(output_files), args.merged_output)
+  if args.index_file is not None:
+    records, people = people_index.build(output_files, args.index_file)
+    print 'indexed %d people from %d records into %s' % (
+        people, records, args.index_file)
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+#
+# Tests of the http client and fetcher in util against a local server.
+# Run with: python test_http.py
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import util
+import zlib
+
+BODY = 'hello ' * 100
+ETAG = '"v1"'
+
+def raw_deflate(data):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+def gzip_compress(data):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+ENCODED = {
+    'gzip': gzip_compress,
+    'deflate': zlib.compress,
+    'raw-deflate': raw_deflate,
+}
+if util.brotli is not None:
+  ENCODED['br'] = util.brotli.compress
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+    self.lock = threading.Lock()
+    # (method, path, body, client port) of every request.
+    self.requests = []
+    # Requests so far per path, for the flaky ones.
+    self.hits = {}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Keeps connections alive unless told otherwise.
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, status, body='', headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def handle_request(self, method):
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length)
+    server = self.server
+    with server.lock:
+      server.requests.append((method, self.path, body, self.client_address[1]))
+      hits = server.hits[self.path] = server.hits.get(self.path, 0) + 1
+    parts = self.path.strip('/').split('/')
+    if parts[0] == 'hello':
+      self.reply(200, BODY)
+    elif parts[0] == 'drop':
+      # Answers as if keeping the connection alive, then closes it.
+      self.reply(200, BODY)
+      self.close_connection = True
+    elif parts[0] == 'encoded':
+      self.reply(200, ENCODED[parts[1]](BODY), {
+          'Content-Encoding': 'deflate' if parts[1] == 'raw-deflate'
+                              else parts[1]})
+    elif parts[0] == 'echo':
+      self.reply(200, '%s %s' % (method, body))
+    elif parts[0] == 'redirect':
+      self.reply(int(parts[1]), '', {'Location': '/echo'})
+    elif parts[0] == 'loop':
+      self.reply(302, '', {'Location': '/loop'})
+    elif parts[0] == 'etag':
+      if self.headers.get('If-None-Match') == ETAG:
+        self.reply(304, '', {'ETag': ETAG})
+      else:
+        self.reply(200, BODY, {'ETag': ETAG})
+    elif parts[0] == 'flaky':
+      # Fails twice, then succeeds.
+      if hits <= 2:
+        self.reply(503)
+      else:
+        self.reply(200, BODY)
+    elif parts[0] == 'throttled':
+      if hits <= 1:
+        self.reply(429, '', {'Retry-After': '0'})
+      else:
+        self.reply(200, BODY)
+    else:
+      self.reply(int(parts[0]))
+
+  def do_GET(self):
+    self.handle_request('GET')
+
+  def do_POST(self):
+    self.handle_request('POST')
+
+class HttpTest(unittest.TestCase):
+  def setUp(self):
+    self.server = Server()
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   args=(0.01,))
+    self.thread.daemon = True
+    self.thread.start()
+    self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.client = util.HttpClient()
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def ports(self):
+    with self.server.lock:
+      return [request[3] for request in self.server.requests]
+
+class HttpClientTest(HttpTest):
+  def test_keep_alive(self):
+    for _ in range(3):
+      response = self.client.request('%s/hello' % self.base)
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.body, BODY)
+    self.assertEqual(len(self.ports()), 3)
+    self.assertEqual(len(set(self.ports())), 1)
+
+  def test_stale_connection_is_retried(self):
+    self.client.request('%s/drop' % self.base)
+    response = self.client.request('%s/hello' % self.base)
+    self.assertEqual(response.body, BODY)
+    ports = self.ports()
+    self.assertNotEqual(ports[0], ports[-1])
+
+  def test_fresh_connection_is_not_retried(self):
+    # Nothing listens on the port of a closed server.
+    self.server.shutdown()
+    self.server.server_close()
+    self.assertRaises(socket.error, self.client.request,
+                      '%s/hello' % self.base)
+
+  def test_decoding(self):
+    for encoding in sorted(ENCODED):
+      response = self.client.request('%s/encoded/%s' % (self.base, encoding))
+      self.assertEqual(response.body, BODY, encoding)
+
+  @unittest.skipIf(util.brotli is None, 'brotli is not installed')
+  def test_accepts_brotli(self):
+    self.assertIn('br', util.ACCEPT_ENCODING)
+
+  def test_redirects(self):
+    for status in util.REDIRECT_STATUSES:
+      response = self.client.request('%s/redirect/%d' % (self.base, status))
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.url, '%s/echo' % self.base)
+      self.assertEqual(response.body, 'GET ')
+
+  def test_post_redirects(self):
+    for status in (301, 302, 303):
+      response = self.client.request(
+          '%s/redirect/%d' % (self.base, status), 'a=1')
+      self.assertEqual(response.body, 'GET ', status)
+    for status in (307, 308):
+      response = self.client.request(
+          '%s/redirect/%d' % (self.base, status), 'a=1')
+      self.assertEqual(response.body, 'POST a=1', status)
+
+  def test_too_many_redirects(self):
+    self.assertRaises(AssertionError, self.client.request,
+                      '%s/loop' % self.base)
+    self.assertEqual(len(self.ports()), util.MAX_REDIRECTS + 1)
+
+  def test_not_modified(self):
+    url = '%s/etag' % self.base
+    response = self.client.request(url)
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.headers['etag'], ETAG)
+    response = self.client.request(url, headers={'If-None-Match': ETAG})
+    self.assertEqual(response.status, 304)
+    self.assertEqual(response.body, '')
+
+  def test_error_status(self):
+    try:
+      self.client.request('%s/404' % self.base)
+    except util.HttpError as e:
+      self.assertEqual(e.status, 404)
+    else:
+      self.fail('no HttpError')
+
+class FetcherTest(HttpTest):
+  def setUp(self):
+    HttpTest.setUp(self)
+    self.saved = (util.http_client, util.rate_limiter, util.retry_budget,
+                  util.metrics, util.BACKOFF_SECS)
+    util.http_client = self.client
+    util.rate_limiter = util.RateLimiter(rate=0)
+    util.retry_budget = util.RetryBudget()
+    util.BACKOFF_SECS = 0
+    util.metrics = util.Metrics()
+    self.fetcher = util.Fetcher()
+    self.download_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    (util.http_client, util.rate_limiter, util.retry_budget, util.metrics,
+     util.BACKOFF_SECS) = self.saved
+    shutil.rmtree(self.download_dir)
+    HttpTest.tearDown(self)
+
+  def fetch_error(self, path):
+    try:
+      self.fetcher.request('%s/%s' % (self.base, path), None)
+    except util.FetchError as e:
+      return e
+    self.fail('no FetchError')
+
+  def test_classify_error(self):
+    def http_error(status, headers=None):
+      return util.HttpError('http://x/', status, headers or {})
+    self.assertEqual(util.classify_error(http_error(429)), 'throttled')
+    self.assertEqual(util.classify_error(
+        http_error(503, {'retry-after': '1'})), 'throttled')
+    self.assertEqual(util.classify_error(http_error(503)), 'server')
+    self.assertEqual(util.classify_error(http_error(500)), 'server')
+    self.assertEqual(util.classify_error(http_error(404)), 'client')
+    self.assertEqual(util.classify_error(socket.timeout()), 'timeout')
+    self.assertEqual(util.classify_error(socket.gaierror()), 'dns')
+    self.assertEqual(util.classify_error(socket.error()), 'connection')
+    self.assertEqual(util.classify_error(httplib.BadStatusLine('')),
+                     'connection')
+    self.assertEqual(util.classify_error(ValueError()), 'other')
+
+  def test_server_errors_are_retried(self):
+    response = self.fetcher.request('%s/flaky' % self.base, None)
+    self.assertEqual(response.body, BODY)
+    self.assertEqual(len(self.ports()), 3)
+
+  def test_throttling_is_retried(self):
+    response = self.fetcher.request('%s/throttled' % self.base, None)
+    self.assertEqual(response.body, BODY)
+    self.assertEqual(len(self.ports()), 2)
+
+  def test_client_errors_are_final(self):
+    e = self.fetch_error('404')
+    self.assertEqual((e.kind, e.attempts), ('client', 1))
+
+  def test_retries_run_out(self):
+    e = self.fetch_error('500')
+    self.assertEqual((e.kind, e.attempts), ('server', util.MAX_RETRIES + 1))
+
+  def test_retry_budget_runs_out(self):
+    util.retry_budget = util.RetryBudget(per_host=1)
+    e = self.fetch_error('500')
+    self.assertEqual(e.attempts, 2)
+
+  def test_not_modified(self):
+    url = '%s/etag' % self.base
+    output_file = util.get_download_file(self.download_dir, url)
+    self.fetcher.fetch_one(url, output_file, None)
+    self.fetcher.fetch_one(url, output_file, None)
+    with open(output_file) as fp:
+      self.assertEqual(fp.read(), BODY)
+    self.assertTrue(util.is_complete_download(output_file, url))
+    self.assertEqual(util.metrics.counters.get(
+        ('downloads', (('result', 'not_modified'),))), 1)
+
+if __name__ == '__main__':
+  unittest.main()
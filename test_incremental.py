@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Tests of --incremental runs in util, with a scraper of a made-up page.
+# Run with: python test_incremental.py
+
+import os
+import shutil
+import tempfile
+import unittest
+import util
+
+# One person per line; a line without a name fails to extract.
+PAGE = 'Ann Lee\n\nBo Kim\n'
+
+def parse(download_file, counts):
+  items = []
+  with open(download_file) as fp:
+    rows = fp.read().splitlines()
+  for i, row in enumerate(rows):
+    with util.quarantine(i, row):
+      assert row, 'no name'
+      items.append({'name': row})
+      counts['total'] += 1
+  return items
+
+class IncrementalTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.processed_dir = '%s/processed' % self.tmp_dir
+    os.makedirs(self.processed_dir)
+    self.download_file = '%s/page-1.html' % self.tmp_dir
+    with open(self.download_file, 'w') as fp:
+      fp.write(PAGE)
+    self.saved = (util.incremental, util.journal, util.errors_file,
+                  util.metrics, util.PARSE_CACHE)
+    util.journal = None
+    util.errors_file = '%s/%s' % (self.processed_dir, util.ERRORS_FILENAME)
+    util.metrics = util.Metrics()
+    util.PARSE_CACHE = False
+
+  def tearDown(self):
+    (util.incremental, util.journal, util.errors_file, util.metrics,
+     util.PARSE_CACHE) = self.saved
+    del util.quarantined[:]
+    shutil.rmtree(self.tmp_dir)
+
+  def run_scraper(self):
+    # Returns the counts of one run and whether the page was parsed.
+    util.incremental = util.Incremental(self.processed_dir)
+    del util.quarantined[:]
+    counts = {'total': 0}
+    output_file = util.get_output_file(self.download_file, self.processed_dir)
+    parsed = not util.is_processed(
+        self.download_file, output_file, True, counts)
+    if parsed:
+      items = util.cached_parse(
+          'test', 1, self.download_file, self.processed_dir,
+          lambda: parse(self.download_file, counts), counts)
+      util.write_items(output_file, items, 'test', self.download_file)
+    util.incremental.finish()
+    util.write_quarantined()
+    return counts, parsed
+
+  def test_unchanged_page_replays_quarantine_and_counts(self):
+    counts, parsed = self.run_scraper()
+    self.assertTrue(parsed)
+    self.assertEqual(counts, {'total': 2})
+    self.assertEqual([e['row'] for e in util.quarantined], [1])
+
+    counts, parsed = self.run_scraper()
+    self.assertFalse(parsed)
+    self.assertEqual(counts, {'total': 2})
+    self.assertEqual([e['row'] for e in util.quarantined], [1])
+    self.assertTrue(os.path.isfile(util.errors_file))
+
+  def test_changed_page_is_parsed(self):
+    self.run_scraper()
+    with open(self.download_file, 'w') as fp:
+      fp.write('Ann Lee\nBo Kim\n')
+    counts, parsed = self.run_scraper()
+    self.assertTrue(parsed)
+    self.assertEqual(counts, {'total': 2})
+    self.assertEqual(util.quarantined, [])
+    self.assertFalse(os.path.isfile(util.errors_file))
+
+if __name__ == '__main__':
+  unittest.main()
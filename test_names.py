@@ -0,0 +1,39 @@
+#!/usr/bin/python
+#
+# Tests of name normalization and keys in util.
+# Run with: python test_names.py
+
+import unittest
+import util
+
+class NamesTest(unittest.TestCase):
+  def assertName(self, raw, name, key):
+    self.assertEqual(util.normalize_name(raw), name)
+    self.assertEqual(util.get_name_key(raw), key)
+
+  def test_flip(self):
+    self.assertName(u'Lee, Ann', u'Ann Lee', u'ann lee')
+    self.assertName(u'  Ann\xa0 Lee ', u'Ann Lee', u'ann lee')
+    self.assertName(u'A, B, C', u'A, B, C', u'a b c')
+    self.assertName(u'', u'', u'')
+
+  def test_suffixes(self):
+    for raw in (u'Ann Lee Jr.', u'ANN LEE JR', u'Ann Lee, Jr.',
+                u'Lee, Ann Jr.', u'Lee, Jr., Ann', u'Lee Jr., Ann'):
+      self.assertName(raw, util.normalize_name(raw), u'ann lee')
+    self.assertName(u'Lee, Ph.D., Ann', u'Ann Lee Ph.D.', u'ann lee')
+    self.assertName(u'Lee, Ann, M.D.', u'Ann Lee M.D.', u'ann lee')
+    self.assertName(u'Ann Bo Lee III', u'Ann Bo Lee III', u'ann bo lee')
+
+  def test_suffix_like_names(self):
+    self.assertName(u'Md Rahman', u'Md Rahman', u'md rahman')
+    self.assertName(u'Rahman, Md', u'Md Rahman', u'md rahman')
+    self.assertName(u'Rahman, Md, Jr.', u'Md Rahman Jr.', u'md rahman')
+    self.assertName(u'Ivan Iv', u'Ivan Iv', u'ivan iv')
+    self.assertName(u'Iv, Ivan', u'Ivan Iv', u'ivan iv')
+    self.assertName(u'Jr.', u'Jr.', u'jr')
+    self.assertNotEqual(util.get_name_key(u'Md Rahman'),
+                        util.get_name_key(u'Rahman'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# Tests of building and searching the people index.
+# Run with: python test_people_index.py
+
+import json
+import people_index
+import shutil
+import tempfile
+import unittest
+
+NAMES = [u'Lee, Ann', u'Md Rahman', u'Rahman, Bo', u'Ivan Iv', u'Jo Ivy',
+         u'Cy Kent Jr.', u'Jos\xe9 \xc1lvarez']
+
+class PeopleIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    output_file = '%s/page-1.jsonl' % self.tmp_dir
+    with open(output_file, 'w') as fp:
+      for name in NAMES:
+        fp.write('%s\n' % json.dumps({
+            'name': name, 'title': 'phd', 'email': None, 'school': 'x',
+            'source_url': 'http://x/', 'page': 1}))
+    index_file = '%s/index.db' % self.tmp_dir
+    self.assertEqual(people_index.build([output_file], index_file),
+                     (len(NAMES), len(NAMES)))
+    self.index = people_index.PeopleIndex(index_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def search(self, prefix):
+    return sorted(person['name'] for person in self.index.search_name(prefix))
+
+  def test_search(self):
+    self.assertEqual(self.search(u'ann'), [u'Lee, Ann'])
+    self.assertEqual(self.search(u'LEE'), [u'Lee, Ann'])
+    self.assertEqual(self.search(u'alv'), [u'Jos\xe9 \xc1lvarez'])
+    self.assertEqual(self.search(u'rahman'), [u'Md Rahman', u'Rahman, Bo'])
+    self.assertEqual(self.search(u''), [])
+    self.assertEqual(self.search(u'.'), [])
+
+  def test_suffix_like_names(self):
+    self.assertEqual(self.search(u'Md'), [u'Md Rahman'])
+    self.assertEqual(self.search(u'Md Rah'), [u'Md Rahman'])
+    self.assertEqual(self.search(u'Iv'), [u'Ivan Iv', u'Jo Ivy'])
+    self.assertEqual(self.search(u'Ivan Iv'), [u'Ivan Iv'])
+    self.assertEqual(self.search(u'Kent Jr'), [u'Cy Kent Jr.'])
+    self.assertEqual(self.search(u'Cy Kent'), [u'Cy Kent Jr.'])
+
+if __name__ == '__main__':
+  unittest.main()
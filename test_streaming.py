@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Tests of streaming table rows in util, and of columbia's use of them.
+# Run with: python test_streaming.py
+
+import process_columbia
+import shutil
+import tempfile
+import unittest
+import util
+
+ROW = '<tr><td>%s</td><td></td><td></td><td></td></tr>'
+
+# Anchors name the table after them, unless another table is in between.
+DIR_PAGE = ''.join([
+    '<html><body>',
+    '<a name="faculty"></a><a name="PhD_student"></a><h2>PhD</h2>',
+    '<table>%s</table>' % (ROW % 'Ann Lee'),
+    '<a name="MS_student"></a><p>MS</p>',
+    '<table>%s</table>' % (ROW % 'Bo Kim'),
+    '<table>%s</table>' % (ROW % 'No Title'),
+    '<div><a name="postdoc"></a></div>',
+    '<table>%s</table>' % (ROW % 'Cy Dee'),
+    '</body></html>',
+])
+
+FILLER = '<div><p>filler</p><span>filler</span></div>\n'
+
+class StreamingTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.saved = util.STREAM_CHUNK_BYTES
+
+  def tearDown(self):
+    util.STREAM_CHUNK_BYTES = self.saved
+    shutil.rmtree(self.tmp_dir)
+
+  def write_page(self, html):
+    download_file = '%s/page-1.html' % self.tmp_dir
+    with open(download_file, 'w') as fp:
+      fp.write(html)
+    return download_file
+
+  def test_columbia_titles(self):
+    download_file = self.write_page(DIR_PAGE)
+    expected = [{'name': u'Ann Lee', 'title': util.Title.PHD},
+                {'name': u'Bo Kim', 'title': util.Title.MASTER}]
+    self.assertEqual(process_columbia.stream_dir(download_file), expected)
+    for parser in util.BACKENDS:
+      self.assertEqual(process_columbia.process_dir(
+          util.make_soup(download_file, parser)), expected, parser)
+
+  def test_memory_is_bounded(self):
+    # However much comes before and around the rows, only a few elements of
+    # the page are left in the tree.
+    util.STREAM_CHUNK_BYTES = 1024
+    download_file = self.write_page(''.join([
+        '<html><body><div>', FILLER * 2000, '</div><table>',
+        ''.join(ROW % i for i in range(2000)), '</table>', FILLER * 2000,
+        '<table>', ROW % 'last', '</table></body></html>']))
+    sizes = []
+    names = []
+    for table, tr in util.stream_rows(download_file):
+      names.append(tr.find('td').get_text())
+      sizes.append(sum(1 for _ in table.el.getroottree().iter()))
+    self.assertEqual(names, [str(i) for i in range(2000)] + ['last'])
+    self.assertLess(max(sizes), 200)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,57 @@
+from bs4 import BeautifulSoup
+from bs4.dammit import UnicodeDammit
+from lxml import etree
+
+import bisect
+import collections
+import contextlib
+import cProfile
+import datetime
+import email.utils
+import gzip
+import hashlib
+import httplib
+import io
+import json
+import lxml.html
+import mmap
 import os
+import pstats
+import Queue
+import random
+import re
+import resource
+import socket
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import unicodedata
+import urlparse
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  import pyarrow
+  import pyarrow.json
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
 
 OVERWRITE_DOWNLOAD = False
 OVERWRITE_PROCESSED = True
@@ -31,6 +83,155 @@ class Title:
          ALUMNI, UNDERGRAD_ALUMNI, GRAD_ALUMNI, MASTER_ALUMNI,
          PHD_ALUMNI, POSTDOC_ALUMNI, STAFF_ALUMNI, OTHER]
 
+  # Which title to keep when one person is listed under several: current
+  # before alumni, then the most senior, then the most specific.
+  PRECEDENCE = [STAFF, POSTDOC, PHD, MASTER, GRAD, UNDERGRAD,
+                STAFF_ALUMNI, POSTDOC_ALUMNI, PHD_ALUMNI, MASTER_ALUMNI,
+                GRAD_ALUMNI, UNDERGRAD_ALUMNI, ALUMNI, OTHER]
+
+  @staticmethod
+  def rank(title):
+    # Lower ranks take precedence; unknown titles come last.
+    if title in Title.PRECEDENCE:
+      return Title.PRECEDENCE.index(title)
+    return len(Title.PRECEDENCE)
+
+##########
+# Titles #
+##########
+
+# Distinct raw positions remembered per TitleClassifier; directories use a
+# few dozen, so the memo is simply reset if it ever fills up.
+TITLE_MEMO_SIZE = 4096
+
+class TitleClassifier(object):
+  # Maps raw position strings to Title values, or None for positions not of
+  # interest.  rules are (labels, title) in priority order, or a dict of label
+  # to title.  All rules compile into one regex with a group per rule, tried
+  # in order, so a position is classified by a single match.  Labels match
+  # the whole position (EXACT), any comma-separated item of it (ITEM) or
+  # anywhere in it (CONTAINS), and the first rule with a match wins.  Case
+  # matters unless ignore_case.  With strict, positions that match no rule
+  # are an error.
+  EXACT = 'exact'
+  ITEM = 'item'
+  CONTAINS = 'contains'
+
+  PATTERNS = {
+      EXACT: r'(%s)\Z',
+      ITEM: r'(?:.*,)?\s*(%s)\s*(?:,.*)?\Z',
+      CONTAINS: r'.*?(%s)',
+  }
+
+  def __init__(self, rules, match=EXACT, strict=False, ignore_case=False):
+    if isinstance(rules, dict):
+      rules = [([label], title) for label, title in sorted(rules.iteritems())]
+    self.titles = [title for _, title in rules]
+    self.regex = re.compile('|'.join(
+        self.PATTERNS[match] % '|'.join(re.escape(label) for label in labels)
+        for labels, _ in rules),
+        re.DOTALL | (re.IGNORECASE if ignore_case else 0))
+    self.strict = strict
+    self.memo = {}
+
+  def classify(self, position):
+    position = position.strip()
+    rule = self.memo.get(position, -1)
+    if rule == -1:
+      m = self.regex.match(position)
+      rule = m.lastindex - 1 if m is not None else None
+      if len(self.memo) >= TITLE_MEMO_SIZE:
+        self.memo.clear()
+      self.memo[position] = rule
+    assert rule is not None or not self.strict, (
+        'unknown position: %s' % position)
+    return self.titles[rule] if rule is not None else None
+
+#########
+# Names #
+#########
+
+# Lowercase, without periods.
+NAME_SUFFIXES = frozenset(['jr', 'sr', 'ii', 'iii', 'iv', 'phd', 'md'])
+NAME_SPACE_RE = re.compile(u'[\\s\u200b\ufeff]+', re.UNICODE)
+# Dropped from name keys; other punctuation separates words.
+NAME_KEY_DROP_RE = re.compile(u"[.'\u2019]", re.UNICODE)
+NAME_KEY_SPLIT_RE = re.compile(r'[\W_]+', re.UNICODE)
+# Distinct raw names remembered; reset if it ever fills up.
+NAME_MEMO_SIZE = 1 << 16
+
+def is_name_suffix(part):
+  return all(token.lower().replace('.', '') in NAME_SUFFIXES
+             for token in part.split(' '))
+
+def pop_name_suffixes(part, min_words):
+  # Splits the suffixes trailing at least min_words other words off part.
+  tokens = part.split(' ')
+  suffixes = []
+  while len(tokens) > min_words and is_name_suffix(tokens[-1]):
+    suffixes.insert(0, tokens.pop())
+  return u' '.join(tokens), suffixes
+
+def split_name(name):
+  # "Last, First Jr." and "Last, Jr., First" to ("First Last", ["Jr."]).
+  # Only comma-separated or trailing words are suffixes, so "Md Rahman" and
+  # "Ivan Iv" keep theirs.  Names with more than one comma besides suffixes
+  # are kept in order.
+  parts = [part.strip() for part in name.split(',') if part.strip()]
+  suffix_indexes = [i for i, part in enumerate(parts) if is_name_suffix(part)]
+  if len(suffix_indexes) == len(parts):
+    return name, []
+  if (len(suffix_indexes) == len(parts) - 1 and suffix_indexes
+      and ' ' not in u''.join(parts) and '.' not in parts[suffix_indexes[0]]):
+    # "Rahman, Md" is a last and a first name, unlike "Lee, Jr.".
+    suffix_indexes.pop(0)
+  suffixes = [parts[i] for i in suffix_indexes]
+  parts = [part for i, part in enumerate(parts) if i not in suffix_indexes]
+  if len(parts) == 2:
+    last, last_suffixes = pop_name_suffixes(parts[0], 1)
+    first, first_suffixes = pop_name_suffixes(parts[1], 1)
+    return (u'%s %s' % (first, last),
+            first_suffixes + last_suffixes + suffixes)
+  if len(parts) == 1:
+    name, trailing = pop_name_suffixes(parts[0], 2)
+    return name, trailing + suffixes
+  return u', '.join(parts), suffixes
+
+def fold_words(name):
+  # Lowercase ascii-folded words of name.
+  name = unicodedata.normalize('NFKD', name)
+  name = u''.join(c for c in name if not unicodedata.combining(c)).lower()
+  return NAME_KEY_SPLIT_RE.sub(u' ', NAME_KEY_DROP_RE.sub(u'', name)).split()
+
+_names = {}
+
+def _parse_name(raw):
+  parsed = _names.get(raw)
+  if parsed is None:
+    name = raw.decode('utf-8', 'replace') if isinstance(raw, str) else raw
+    name, suffixes = split_name(NAME_SPACE_RE.sub(u' ', name).strip())
+    if len(_names) >= NAME_MEMO_SIZE:
+      _names.clear()
+    parsed = _names[raw] = (u' '.join([name] + suffixes),
+                            u' '.join(fold_words(name)))
+  return parsed
+
+def normalize_name(raw):
+  # Display name: whitespace (including nbsp) collapsed and "Last, First"
+  # flipped.
+  return _parse_name(raw)[0]
+
+def get_name_key(raw):
+  # Canonical key of a name for dedup, the same for "Last, First",
+  # "First Last", "FIRST LAST Jr." or the name with accents.
+  return _parse_name(raw)[1]
+
+def get_name_prefix_key(raw):
+  # The words of a name to search by, or of the start of one, folded like
+  # get_name_key but keeping suffixes, as "Iv" may be the start of "Ivy".
+  name = raw.decode('utf-8', 'replace') if isinstance(raw, str) else raw
+  return u' '.join(fold_words(_parse_name(name)[0]))
+
 ############
 # IO utils #
 ############
@@ -44,24 +245,2363 @@ def prepare_dirs(url_subdir_map, download_dir, processed_dir):
       if not os.path.isdir(sdir):
         os.makedirs(sdir)
 
+def write_file(output_file, content):
+  # Write to a temp file and rename, so readers never see a partial file.  The
+  # data is synced first so that the rename cannot survive a crash without it.
+  tmp_file = '%s.tmp' % output_file
+  with open(tmp_file, 'wb') as fp:
+    fp.write(content)
+    fp.flush()
+    os.fsync(fp.fileno())
+  os.rename(tmp_file, output_file)
+
+def sha1(content):
+  return hashlib.sha1(content).hexdigest()
+
+def file_sha1(afile):
+  # None if afile does not exist.
+  if not os.path.isfile(afile):
+    return None
+  with open(afile, 'rb') as fp:
+    return sha1(fp.read())
+
+URL_KEY_HASH_CHARS = 10
+URL_KEY_SLUG_CHARS = 40
+
+def get_url_key(url, post_data=None):
+  # Stable file name for a request, whatever order urls are crawled in: the
+  # tail of a slug of the url path and query, for readability, plus a hash of
+  # the whole request.  DownloadMeta maps the name back to the url.
+  parsed = urlparse.urlparse(url)
+  slug = re.sub(r'[^a-z0-9]+', '-', (
+      '%s?%s' % (parsed.path, parsed.query)).lower())
+  if len(slug) > URL_KEY_SLUG_CHARS:
+    slug = slug[-URL_KEY_SLUG_CHARS:].partition('-')[2]
+  slug = slug.strip('-')
+  digest = sha1('%s\0%s' % (url, post_data or ''))[:URL_KEY_HASH_CHARS]
+  return '%s-%s' % (slug, digest) if slug else digest
+
+def get_download_file(download_dir, url, post_data=None):
+  return '%s/%s.html' % (download_dir, get_url_key(url, post_data))
+
+class DownloadMeta(object):
+  # Records, for each file in a download dir, the url it was fetched from,
+  # its validators (etag, last-modified), content hash and fetch time.
+  FILENAME = '.download_meta.json'
+
+  def __init__(self, adir):
+    self.meta_file = '%s/%s' % (adir, self.FILENAME)
+    self.lock = threading.Lock()
+    self.entries = {}
+    if os.path.isfile(self.meta_file):
+      with open(self.meta_file) as fp:
+        self.entries = json.load(fp)
+
+  def get(self, name):
+    with self.lock:
+      return self.entries.get(name)
+
+  def put(self, name, entry):
+    with self.lock:
+      self.entries[name] = entry
+      write_file(self.meta_file, json.dumps(self.entries, indent=1,
+                                            sort_keys=True))
+
+_download_metas = {}
+_download_metas_lock = threading.Lock()
+
+def get_download_meta(adir):
+  adir = os.path.abspath(adir)
+  with _download_metas_lock:
+    if adir not in _download_metas:
+      _download_metas[adir] = DownloadMeta(adir)
+    return _download_metas[adir]
+
+def is_complete_download(download_file, url, post_data=None):
+  # Whether download_file holds the whole response for url, as recorded when
+  # it was fetched.  Files without a record, such as those left by older
+  # runs, may be truncated.
+  entry = get_download_meta(os.path.dirname(download_file)).get(
+      os.path.basename(download_file))
+  return (entry is not None and entry['url'] == url
+          and entry.get('post_data') == post_data
+          and file_sha1(download_file) == entry['sha1'])
+
+def is_processed(download_file, output_file, overwrite, counts):
+  # Whether output_file can be kept as is: it exists and is not overwritable.
+  # An overwritable one is always redone, which for a download that has not
+  # changed is a parse cache hit, so that a new parser version takes effect
+  # and counts still add up.  One kept from an interrupted run adds the
+  # increments its parse made to counts.
+  if incremental is not None:
+    return incremental.is_unchanged(download_file, output_file, counts)
+  if journal is not None and journal.is_processed(
+      download_file, output_file, counts):
+    return True
+  if not os.path.isfile(output_file):
+    return False
+  return not overwrite
+
+##############
+# Blob store #
+##############
+
+# With a BlobStore, every download is also kept compressed, once per distinct
+# content, and indexed by (school, url, fetch time), so that snapshots of all
+# past runs cost little.  In SNAPSHOT mode downloads are read back from the
+# store as they were at that time instead of being fetched.
+BLOB_COMPRESSIONS = ['zstd', 'gzip', 'none']
+BLOB_COMPRESSION = 'zstd' if zstandard is not None else 'gzip'
+BLOB_EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz', 'none': ''}
+BLOB_LEVELS = {'zstd': 10, 'gzip': 6}
+BLOB_INDEX_FILENAME = 'index.jsonl'
+SNAPSHOT_FORMAT = '%Y%m%d-%H%M%S'
+
+def compress_blob(content, compression):
+  if compression == 'zstd':
+    return zstandard.ZstdCompressor(
+        level=BLOB_LEVELS['zstd']).compress(content)
+  if compression == 'gzip':
+    compressor = zlib.compressobj(
+        BLOB_LEVELS['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+  return content
+
+class BlobStore(object):
+  # Blobs are <store_dir>/<2 hex>/<sha1 of content><extension>, and the index
+  # has a line for each fetch that changed a url's content.
+  def __init__(self, store_dir, compression=BLOB_COMPRESSION):
+    assert compression in BLOB_COMPRESSIONS, (
+        'unknown compression: %s' % compression)
+    assert compression != 'zstd' or zstandard is not None, (
+        'zstd compression requires zstandard')
+    self.store_dir = store_dir
+    self.compression = compression
+    self.index_file = '%s/%s' % (store_dir, BLOB_INDEX_FILENAME)
+    self.lock = threading.Lock()
+    # (url, post_data) to its index entries by fetch time, loaded lazily.
+    self.index = None
+
+  def get_path(self, digest, compression):
+    return '%s/%s/%s%s' % (
+        self.store_dir, digest[:2], digest, BLOB_EXTENSIONS[compression])
+
+  def find(self, digest):
+    # Returns (path, compression), whichever compression digest was stored
+    # with, or (None, None).
+    for compression in BLOB_COMPRESSIONS:
+      path = self.get_path(digest, compression)
+      if os.path.isfile(path):
+        return path, compression
+    return None, None
+
+  def put(self, content):
+    digest = sha1(content)
+    if self.find(digest)[0] is not None:
+      return digest
+    path = self.get_path(digest, self.compression)
+    adir = os.path.dirname(path)
+    if not os.path.isdir(adir):
+      try:
+        os.makedirs(adir)
+      except OSError:
+        assert os.path.isdir(adir), adir
+    # Writers of the same blob race to rename complete temp files of their own.
+    fd, tmp_file = tempfile.mkstemp(dir=adir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(compress_blob(content, self.compression))
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp_file, path)
+    return digest
+
+  def read(self, digest):
+    path, compression = self.find(digest)
+    assert path is not None, 'no blob %s in %s' % (digest, self.store_dir)
+    with open(path, 'rb') as fp:
+      data = fp.read()
+    if compression == 'zstd':
+      return zstandard.ZstdDecompressor().decompress(data)
+    if compression == 'gzip':
+      return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+  def open(self, digest):
+    # A file object streaming the content; uncompressed blobs are mapped.
+    path, compression = self.find(digest)
+    assert path is not None, 'no blob %s in %s' % (digest, self.store_dir)
+    if compression == 'zstd':
+      with open(path, 'rb') as fp:
+        return zstandard.ZstdDecompressor().stream_reader(fp.read())
+    if compression == 'gzip':
+      return gzip.open(path, 'rb')
+    with open(path, 'rb') as fp:
+      if os.fstat(fp.fileno()).st_size == 0:
+        return io.BytesIO()
+      return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def load_index(self):
+    # Called with the lock held.  Lines are appended whole by any number of
+    # processes; one cut short by a crash is skipped.
+    if self.index is not None:
+      return
+    self.index = {}
+    if os.path.isfile(self.index_file):
+      with open(self.index_file) as fp:
+        for line in fp:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue
+          self.index.setdefault(
+              (entry['url'], entry['post_data']), []).append(entry)
+    for entries in self.index.itervalues():
+      entries.sort(key=lambda entry: entry['fetched'])
+
+  def add(self, school, url, post_data, fetched, digest, get_content):
+    # Stores get_content(), the content of url fetched at time fetched with
+    # hash digest, unless the index already has it as url's latest content.
+    with self.lock:
+      self.load_index()
+      entries = self.index.setdefault((url, post_data), [])
+      if entries and entries[-1]['sha1'] == digest:
+        return
+    content = get_content()
+    assert self.put(content) == digest, 'content of %s changed' % url
+    entry = collections.OrderedDict([
+        ('school', school), ('url', url), ('post_data', post_data),
+        ('fetched', fetched), ('sha1', digest), ('size', len(content))])
+    with self.lock:
+      fd = os.open(self.index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                   0644)
+      try:
+        os.write(fd, '%s\n' % json.dumps(entry))
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      entries.append(entry)
+      entries.sort(key=lambda entry: entry['fetched'])
+
+  def lookup(self, url, post_data, when):
+    # The index entry of url's content as of time when, None if not fetched
+    # by then.
+    with self.lock:
+      self.load_index()
+      found = None
+      for entry in self.index.get((url, post_data), []):
+        if entry['fetched'] > when:
+          break
+        found = entry
+      return found
+
+# Set by init() with --blob_store, and --snapshot.
+blob_store = None
+SNAPSHOT = None
+SCHOOL = None
+
+# Absolute path of each download read from the store in SNAPSHOT mode to its
+# index entry.
+snapshot_files = {}
+
+def get_snapshot_file(url, download_file, post_data=None):
+  # Returns download_file if url is in the store as of SNAPSHOT, so that the
+  # readers below find it there, else records it as a failed download.
+  entry = blob_store.lookup(url, post_data, SNAPSHOT)
+  if entry is None:
+    log('%s: not in the blob store as of %s' % (url, time.strftime(
+        SNAPSHOT_FORMAT, time.localtime(SNAPSHOT))))
+    failed_downloads.append({'url': url, 'file': download_file,
+                             'kind': 'snapshot', 'error': 'not stored'})
+    return None
+  snapshot_files[os.path.abspath(download_file)] = entry
+  return download_file
+
+def open_download(download_file):
+  # A file object over the content of download_file, which in SNAPSHOT mode
+  # comes from the store.  Not all of them support with, so use closing().
+  entry = snapshot_files.get(os.path.abspath(download_file))
+  if entry is not None:
+    return blob_store.open(entry['sha1'])
+  return open(download_file, 'rb')
+
+def read_download(download_file):
+  entry = snapshot_files.get(os.path.abspath(download_file))
+  if entry is not None:
+    return blob_store.read(entry['sha1'])
+  with open(download_file, 'rb') as fp:
+    return fp.read()
+
+def download_sha1(download_file):
+  entry = snapshot_files.get(os.path.abspath(download_file))
+  if entry is not None:
+    return entry['sha1']
+  return file_sha1(download_file)
+
+def get_source_url(download_file):
+  entry = snapshot_files.get(os.path.abspath(download_file))
+  if entry is None:
+    entry = get_download_meta(os.path.dirname(download_file)).get(
+        os.path.basename(download_file))
+  return entry['url'] if entry is not None else None
+
+##########
+# Emails #
+##########
+
+# The dot-atom local part of RFC 5322, as validate_email matches it, and a
+# host name domain.  The quoted local parts, comments and domain literals
+# validate_email also allows do not occur in directories.
+EMAIL_ATEXT = r"[\w!#$%&'*+\-/=?^`{|}~]"
+EMAIL_LOCAL_RE = re.compile(r'%s+(?:\.%s+)*\Z' % (EMAIL_ATEXT, EMAIL_ATEXT))
+EMAIL_LABEL = r'[a-z0-9](?:[a-z0-9-]*[a-z0-9])?'
+EMAIL_DOMAIN_RE = re.compile(r'%s(?:\.%s)*\Z' % (EMAIL_LABEL, EMAIL_LABEL))
+MAILTO_PREFIX = 'mailto:'
+
+# Domain to whether it is valid; directories repeat a handful of domains.
+_email_domains = {}
+
+def is_email_domain(domain):
+  domain = domain.lower()
+  valid = _email_domains.get(domain)
+  if valid is None:
+    valid = _email_domains[domain] = EMAIL_DOMAIN_RE.match(domain) is not None
+  return valid
+
+def clean_email(email):
+  # Returns email without surrounding space and a mailto: prefix and with the
+  # domain lowercased, or None if it is not a valid address.
+  email = email.strip().replace(u'\xa0', u'')
+  if email[:len(MAILTO_PREFIX)].lower() == MAILTO_PREFIX:
+    email = email[len(MAILTO_PREFIX):]
+  local, at, domain = email.rpartition('@')
+  if not at or not is_email_domain(domain):
+    return None
+  if EMAIL_LOCAL_RE.match(local) is None:
+    return None
+  return '%s@%s' % (local, domain.lower())
+
+def clean_emails(emails):
+  # clean_email over all candidates of a page or crawl, checking each
+  # distinct candidate once.
+  cleaned = {}
+  for email in emails:
+    if email not in cleaned:
+      cleaned[email] = clean_email(email)
+  return [cleaned[email] for email in emails]
+
+################
+# Html parsing #
+################
+
+# Parser backends.  'lxml' is a bare lxml.html tree behind Node, a wrapper
+# exposing the part of the BeautifulSoup api the scrapers use; 'bs4-*' are
+# BeautifulSoup with the named tree builder.
+BACKENDS = ['lxml', 'bs4-lxml', 'bs4-html.parser']
+PARSER = 'lxml'
+# Used when extraction fails on the PARSER tree, typically a malformed page
+# that lxml repairs differently than html.parser would.
+FALLBACK_PARSER = 'bs4-html.parser'
+
+SELECTOR_PART_RE = re.compile(r'([#.]?)([\w-]+)')
+
+def class_predicate(class_):
+  # Same semantics as bs4: a value with spaces must match the attribute
+  # exactly, a single name matches any of the element's classes.
+  if ' ' in class_:
+    return '@class="%s"' % class_
+  return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % class_
+
+def selector_to_xpath(selector):
+  # Supports the simple selectors the scrapers use: tag, .class and #id
+  # compounds, joined by descendant (space) or child (>) combinators.
+  xpath = '.'
+  axis = '//'
+  for token in selector.replace('>', ' > ').split():
+    if token == '>':
+      axis = '/'
+      continue
+    tag = '*'
+    predicates = []
+    for kind, value in SELECTOR_PART_RE.findall(token):
+      if kind == '#':
+        predicates.append('@id="%s"' % value)
+      elif kind == '.':
+        predicates.append(class_predicate(value))
+      else:
+        tag = value
+    xpath += axis + tag + ''.join('[%s]' % p for p in predicates)
+    axis = '//'
+  return xpath
+
+_xpaths = {}
+
+def compile_xpath(key, build):
+  xpath = _xpaths.get(key)
+  if xpath is None:
+    xpath = _xpaths[key] = etree.XPath(build())
+  return xpath
+
+def find_xpath(name, class_, id, axis):
+  predicates = []
+  if class_ is not None:
+    predicates.append(class_predicate(class_))
+  if id is not None:
+    predicates.append('@id="%s"' % id)
+  return '%s%s%s' % (
+      axis, name or '*', ''.join('[%s]' % p for p in predicates))
+
+class Node(object):
+  __slots__ = ('el',)
+
+  def __init__(self, el):
+    self.el = el
+
+  @property
+  def name(self):
+    return self.el.tag
+
+  @property
+  def attrs(self):
+    return dict(self.el.attrib)
+
+  def __getitem__(self, key):
+    return self.el.attrib[key]
+
+  def get(self, key, default=None):
+    return self.el.attrib.get(key, default)
+
+  def find_all(self, name=None, class_=None, id=None):
+    xpath = compile_xpath(
+        ('find', name, class_, id),
+        lambda: find_xpath(name, class_, id, './/'))
+    return [Node(el) for el in xpath(self.el)]
+
+  def find(self, name=None, class_=None, id=None):
+    nodes = self.find_all(name, class_, id)
+    return nodes[0] if nodes else None
+
+  def find_next_sibling(self, name=None, class_=None, id=None):
+    xpath = compile_xpath(
+        ('sibling', name, class_, id),
+        lambda: find_xpath(name, class_, id, 'following-sibling::'))
+    els = xpath(self.el)
+    return Node(els[0]) if els else None
+
+  findNextSibling = find_next_sibling
+
+  def find_previous_sibling(self, name=None, class_=None, id=None):
+    xpath = compile_xpath(
+        ('previous', name, class_, id),
+        lambda: find_xpath(name, class_, id, 'preceding-sibling::'))
+    els = xpath(self.el)
+    return Node(els[-1]) if els else None
+
+  findPreviousSibling = find_previous_sibling
+
+  def select(self, selector):
+    xpath = compile_xpath(
+        ('select', selector), lambda: selector_to_xpath(selector))
+    return [Node(el) for el in xpath(self.el)]
+
+  def get_text(self):
+    return unicode(self.el.xpath('string()'))
+
+  @property
+  def stripped_strings(self):
+    for text in self.el.itertext():
+      text = text.strip()
+      if text:
+        yield unicode(text)
+
+  def __eq__(self, other):
+    return isinstance(other, Node) and self.el is other.el
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.el)
+
+  def __unicode__(self):
+    return etree.tostring(self.el, encoding=unicode, with_tail=False)
+
+  def __str__(self):
+    return etree.tostring(self.el, with_tail=False)
+
+  __repr__ = __str__
+
+def parse_lxml(content, encoding=None):
+  # lxml falls back to latin-1 without a charset declaration, so detect the
+  # encoding the way BeautifulSoup would.
+  if encoding is None:
+    encoding = UnicodeDammit(content, is_html=True).original_encoding
+  parser = lxml.html.HTMLParser(encoding=encoding)
+  return Node(lxml.html.document_fromstring(content, parser=parser))
+
+# The id and class attributes of a start tag, as (possibly quoted) values.
+ATTR_VALUE = r'''\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+)'''
+ID_ATTR_RE = re.compile(r'(?:^|\s)id%s' % ATTR_VALUE, re.I)
+CLASS_ATTR_RE = re.compile(r'(?:^|\s)class%s' % ATTR_VALUE, re.I)
+
+class Region(object):
+  # The part of a page a scraper extracts from: the bytes from the first
+  # element matching selector, a compound of a tag with .class and #id parts,
+  # to the end of the last one.  Only that part is parsed, leaving out the
+  # navigation and other chrome around it, so it has to hold everything the
+  # extraction looks at.
+  def __init__(self, selector):
+    parts = SELECTOR_PART_RE.findall(selector)
+    assert parts and parts[0][0] == '', 'expecting a tag: %s' % selector
+    self.selector = selector
+    self.id = None
+    self.classes = []
+    for kind, value in parts[1:]:
+      if kind == '#':
+        self.id = value
+      else:
+        assert kind == '.', selector
+        self.classes.append(value)
+    self.tag_re = re.compile(
+        r'<(/?)%s(?=[\s/>])([^>]*)>' % re.escape(parts[0][1]), re.I)
+
+  def is_match(self, attrs):
+    if self.id is not None:
+      match = ID_ATTR_RE.search(attrs)
+      if match is None or match.group(1).strip('"\'') != self.id:
+        return False
+    if self.classes:
+      match = CLASS_ATTR_RE.search(attrs)
+      if match is None:
+        return False
+      classes = match.group(1).strip('"\'').split()
+      return all(class_ in classes for class_ in self.classes)
+    return True
+
+  def find(self, content):
+    # (start, end) offsets of the region in content, or None if no element
+    # matches or one is left open.  A single pass over the tags of the
+    # element's name, keeping their depth to tell where a match ends.
+    start = end = None
+    depth = 0
+    open_depth = None
+    for match in self.tag_re.finditer(content):
+      if match.group(1):
+        depth -= 1
+        if depth == open_depth:
+          end = match.end()
+          open_depth = None
+      elif match.group(2).endswith('/'):
+        if open_depth is None and self.is_match(match.group(2)):
+          if start is None:
+            start = match.start()
+          end = match.end()
+      else:
+        if open_depth is None and self.is_match(match.group(2)):
+          open_depth = depth
+          if start is None:
+            start = match.start()
+        depth += 1
+    if start is None or open_depth is not None:
+      return None
+    return start, end
+
+def make_soup(download_file, parser=None, region=None):
+  # With a Region, only that part of the page is parsed, or the whole page if
+  # it cannot be found.
+  parser = parser or PARSER
+  assert parser in BACKENDS, 'unknown parser: %s' % parser
+  content = read_download(download_file)
+  encoding = None
+  if region is not None:
+    span = region.find(content)
+    if span is None:
+      log('%s: no %s, parsing whole page' % (download_file, region.selector))
+      metrics.inc('regions', result='missing')
+    else:
+      metrics.inc('regions', result='found')
+      # The charset is declared ahead of the region, if at all.
+      encoding = sniff_head_encoding(content[:ENCODING_SNIFF_BYTES])
+      content = content[span[0]:span[1]]
+  with metrics.timer('soup', parser=parser):
+    if parser == 'lxml':
+      return parse_lxml(content, encoding)
+    return BeautifulSoup(content, parser[len('bs4-'):],
+                         from_encoding=encoding)
+
+def parse_with_fallback(download_file, extract, counts, parser=None,
+                        fallback=None, region=None):
+  # Returns extract(soup) on a PARSER tree, redoing it on FALLBACK_PARSER if
+  # that fails or quarantines rows.  If the fallback fails as well, the rows
+  # quarantined on the PARSER tree stand.  counts are rolled back to match.
+  # Both trees are of region only, if given (see make_soup).
+  parser = parser or PARSER
+  fallback = fallback or FALLBACK_PARSER
+  if parser == fallback:
+    return extract(make_soup(download_file, parser, region))
+  before = dict(counts)
+  errors = [] if is_quarantining() else None
+  items = None
+  try:
+    with rows_into(errors):
+      items = extract(make_soup(download_file, parser, region))
+    if not errors:
+      return items
+    log('%s: %s parser quarantined %d rows, retrying with %s' % (
+        download_file, parser, len(errors), fallback))
+  except Exception as e:
+    log('%s: %s parser failed (%r), retrying with %s' % (
+        download_file, parser, e, fallback))
+  after = dict(counts)
+  counts.clear()
+  counts.update(before)
+  if items is None:
+    return extract(make_soup(download_file, fallback, region))
+  try:
+    with rows_into(None):
+      return extract(make_soup(download_file, fallback, region))
+  except Exception as e:
+    log('%s: %s parser failed too (%r), keeping quarantined rows' % (
+        download_file, fallback, e))
+  counts.clear()
+  counts.update(after)
+  _rows.errors.extend(errors)
+  return items
+
+# Stream rows of large tables instead of building the whole tree, where a
+# scraper supports it.
+STREAM_ROWS = True
+ENCODING_SNIFF_BYTES = 65536
+STREAM_CHUNK_BYTES = 65536
+# Finished elements kept before the open one at each level, without their
+# children, for callers looking back from a table.
+STREAM_KEEP_SIBLINGS = 16
+
+def sniff_encoding(download_file):
+  with contextlib.closing(open_download(download_file)) as fp:
+    return sniff_head_encoding(fp.read(ENCODING_SNIFF_BYTES))
+
+def sniff_head_encoding(head):
+  # Cut at a line break so a truncated multi-byte character does not throw
+  # off detection.
+  if len(head) == ENCODING_SNIFF_BYTES and '\n' in head:
+    head = head[:head.rfind('\n') + 1]
+  return UnicodeDammit(head, is_html=True).original_encoding
+
+def is_class(el, class_):
+  value = el.get('class') or ''
+  if ' ' in class_:
+    return value == class_
+  return class_ in value.split()
+
+def read_tags(fp, size):
+  # Yields the file in chunks of about size bytes, each cut just after a '>'.
+  # libxml2's html push parser can stop emitting events for good when a chunk
+  # ends inside a quoted attribute value.
+  rest = ''
+  while True:
+    chunk = fp.read(size)
+    if not chunk:
+      break
+    chunk = rest + chunk
+    end = chunk.rfind('>') + 1
+    rest = chunk[end:]
+    if end > 0:
+      yield chunk[:end]
+  if rest:
+    yield rest
+
+def iter_events(download_file, on_chunk=None, **kwargs):
+  # on_chunk() is called after the events of each chunk are consumed.
+  parser = etree.HTMLPullParser(encoding=sniff_encoding(download_file),
+                                **kwargs)
+  with contextlib.closing(open_download(download_file)) as fp:
+    for chunk in read_tags(fp, STREAM_CHUNK_BYTES):
+      parser.feed(chunk)
+      for event in parser.read_events():
+        yield event
+      if on_chunk is not None:
+        on_chunk()
+  parser.close()
+  for event in parser.read_events():
+    yield event
+
+def stream_rows(download_file, class_=None, id=None, index=None):
+  # Yields (table, row) Nodes for each <tr> directly inside a table matching
+  # class_ and id (only the index-th such table if index is given).  The page
+  # is parsed incrementally and each row is discarded once the caller moves
+  # on.  After each chunk, elements that ended outside the selected tables
+  # lose their children and only the last STREAM_KEEP_SIBLINGS of them are
+  # kept at each level, so memory is bounded by one chunk and one row however
+  # long the page.  The table Node only has the rows not yet consumed, and
+  # those few previous siblings.
+  tables = []
+  matches = 0
+  roots = []
+
+  def trim():
+    # Walks down the open elements, which are the last child at each level,
+    # up to the innermost selected table, whose rows go as they are yielded.
+    selected = set(el for el, is_selected in tables if is_selected)
+    el = roots[0] if roots else None
+    while el is not None and el not in selected and len(el):
+      last = len(el) - 1
+      start = max(0, last - STREAM_KEEP_SIBLINGS)
+      for child in el[start:last]:
+        del child[:]
+      del el[:start]
+      el = el[-1]
+
+  events = iter_events(download_file, trim, events=('start', 'end'),
+                       tag=('html', 'table', 'tr'))
+  for event, el in events:
+    if el.tag == 'html':
+      if event == 'start':
+        roots.append(el)
+    elif el.tag == 'table':
+      if event == 'end':
+        tables.pop()
+        continue
+      selected = ((class_ is None or is_class(el, class_))
+                  and (id is None or el.get('id') == id))
+      if selected:
+        selected = index is None or matches == index
+        matches += 1
+      tables.append((el, selected))
+    elif event == 'end' and tables and tables[-1][1]:
+      yield Node(tables[-1][0]), Node(el)
+      el.clear()
+      parent = el.getparent()
+      while el.getprevious() is not None:
+        del parent[0]
+
+def stream_with_fallback(download_file, stream, extract, counts, **kwargs):
+  # Returns stream(download_file) in STREAM_ROWS mode, falling back to
+  # extract on a full tree (see parse_with_fallback) if streaming is off or
+  # fails.
+  if STREAM_ROWS:
+    before = dict(counts)
+    try:
+      with rows_into(None):
+        return stream(download_file)
+    except Exception as e:
+      log('%s: streaming failed (%r), parsing whole page' % (download_file, e))
+    counts.clear()
+    counts.update(before)
+  return parse_with_fallback(download_file, extract, counts, **kwargs)
+
+##############
+# Quarantine #
+##############
+
+# A row whose extraction fails is recorded in ERRORS_FILENAME and skipped, so
+# the rest of its page is still written.
+QUARANTINE = True
+ERRORS_FILENAME = 'errors.jsonl'
+SNIPPET_CHARS = 2000
+
+# The page being parsed in this thread and the list its failing rows go to,
+# or None while a failing row fails the page.
+_rows = threading.local()
+
+# Rows quarantined in this run, written to errors_file by finish().
+quarantined = []
+errors_file = None
+_quarantined_lock = threading.Lock()
+
+def is_quarantining():
+  return getattr(_rows, 'errors', None) is not None
+
+@contextlib.contextmanager
+def rows_into(errors):
+  # Rows failing within the block go to errors, or fail it if errors is None.
+  outer = getattr(_rows, 'errors', None)
+  _rows.errors = errors
+  try:
+    yield
+  finally:
+    _rows.errors = outer
+
+@contextlib.contextmanager
+def quarantining(download_file, errors):
+  # Appends to errors the rows of download_file failing within the block.
+  _rows.download_file = download_file
+  with rows_into(errors if QUARANTINE else None):
+    yield
+
+def get_snippet(row):
+  if isinstance(row, (list, tuple)):
+    snippet = u''.join(unicode(el) for el in row)
+  else:
+    snippet = unicode(row)
+  return snippet[:SNIPPET_CHARS]
+
+@contextlib.contextmanager
+def quarantine(index, row):
+  # Extracts the index-th row of the page within the block, which is skipped
+  # with the row quarantined if it raises.
+  try:
+    with metrics.timer('extract'):
+      yield
+  except Exception as e:
+    errors = getattr(_rows, 'errors', None)
+    if errors is None:
+      raise
+    filename, line = traceback.extract_tb(sys.exc_info()[2])[-1][:2]
+    download_file = _rows.download_file
+    errors.append(collections.OrderedDict([
+        ('file', download_file),
+        ('source_url', get_source_url(download_file)),
+        ('page', get_page(download_file)),
+        ('row', index),
+        ('error', '%s: %s' % (type(e).__name__, e)),
+        ('at', '%s:%d' % (os.path.basename(filename), line)),
+        ('html', get_snippet(row))]))
+
+def add_quarantined(errors):
+  for error in errors:
+    log('%s: quarantined row %d (%s at %s)' % (
+        error['file'], error['row'], error['error'], error['at']))
+  if errors:
+    metrics.inc('rows_quarantined', len(errors))
+  with _quarantined_lock:
+    quarantined.extend(errors)
+
+def write_quarantined():
+  # Writes the rows quarantined in this run to errors_file, removing a stale
+  # one if there are none, and prints a summary.
+  if errors_file is None:
+    return
+  if not quarantined:
+    if os.path.isfile(errors_file):
+      os.remove(errors_file)
+    return
+  write_file(errors_file, ''.join(
+      '%s\n' % json.dumps(error) for error in quarantined))
+  print 'quarantined %d rows from %d pages, see %s' % (
+      len(quarantined), len(set(error['file'] for error in quarantined)),
+      errors_file)
+
+###############
+# Parse cache #
+###############
+
+PARSE_CACHE = True
+PARSE_CACHE_DIRNAME = '.parse_cache'
+
+# The increments to counts of the last parse of each download, which the
+# journal and the incremental manifest keep with its output.
+parse_counts = {}
+
+def cached_parse(scraper, version, download_file, processed_dir, parse,
+                 counts):
+  # Returns parse(), reusing the items extracted by an earlier run of the same
+  # scraper and parser version on byte-identical html.  The increments parse()
+  # makes to counts and the rows it quarantines are stored alongside and
+  # replayed on a hit.
+  digest = download_sha1(download_file)
+  cache_dir = '%s/%s' % (processed_dir, PARSE_CACHE_DIRNAME)
+  cache_file = '%s/%s.json' % (
+      cache_dir, sha1('%s\0%s\0%s' % (scraper, version, digest)))
+  if PARSE_CACHE and os.path.isfile(cache_file):
+    with open(cache_file) as fp:
+      entry = json.load(fp, object_pairs_hook=collections.OrderedDict)
+    # Without quarantine, a page with bad rows has to fail again.
+    errors = entry.get('errors', [])
+    if QUARANTINE or not errors:
+      metrics.inc('parse_cache', result='hit')
+      add_counts(counts, entry['counts'])
+      parse_counts[download_file] = entry['counts']
+      add_quarantined(errors)
+      return entry['items']
+
+  metrics.inc('parse_cache', result='miss' if PARSE_CACHE else 'off')
+  before = dict(counts)
+  errors = []
+  with quarantining(download_file, errors), metrics.timer('parse'):
+    with profiling('parse', download_file):
+      items = parse()
+  delta = {}
+  for name, value in counts.iteritems():
+    if value != before.get(name, 0):
+      delta[name] = value - before.get(name, 0)
+  if PARSE_CACHE:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    write_file(cache_file, json.dumps(
+        {'items': items, 'counts': delta, 'errors': errors}))
+  parse_counts[download_file] = delta
+  add_quarantined(errors)
+  return items
+
+def add_counts(counts, delta):
+  for name, value in delta.iteritems():
+    counts[name] = counts.get(name, 0) + value
+
+##########
+# Output #
+##########
+
+# Every output record has these fields, in this order; missing ones are null.
+FIELDS = ['name', 'title', 'email', 'school', 'source_url', 'page']
+ITEM_FIELDS = FIELDS[:3]
+# Output format to file extension.
+OUTPUT_FORMATS = collections.OrderedDict([
+    ('jsonl', 'jsonl'),
+    ('parquet', 'parquet'),
+])
+OUTPUT_FORMAT = 'jsonl'
+
+def get_schema():
+  return pyarrow.schema(
+      [(field, pyarrow.string()) for field in FIELDS[:-1]] +
+      [('page', pyarrow.int32())])
+
+def get_page(download_file):
+  # Pages of paginated listings are named page-<n>.html, other downloads
+  # after their url and have no page number.
+  name = os.path.splitext(os.path.basename(download_file))[0]
+  if not re.match(r'page-\d+$', name):
+    return None
+  return int(name[len('page-'):])
+
+def get_output_file(download_file, processed_dir, output_format=None):
+  name = os.path.splitext(os.path.basename(download_file))[0]
+  return '%s/%s.%s' % (
+      processed_dir, name, OUTPUT_FORMATS[output_format or OUTPUT_FORMAT])
+
+def make_records(items, school, download_file):
+  source_url = get_source_url(download_file)
+  page = get_page(download_file)
+  records = []
+  for item in items:
+    assert set(item) <= set(ITEM_FIELDS), item
+    record = collections.OrderedDict(
+        (field, item.get(field)) for field in ITEM_FIELDS)
+    record['school'] = school
+    record['source_url'] = source_url
+    record['page'] = page
+    records.append(record)
+  return records
+
+def write_jsonl(output_file, records):
+  write_file(output_file, ''.join(
+      '%s\n' % json.dumps(record) for record in records))
+
+def write_parquet(output_file, records):
+  schema = get_schema()
+  columns = [pyarrow.array([record[field] for record in records],
+                           type=schema.field(field).type)
+             for field in FIELDS]
+  tmp_file = '%s.tmp' % output_file
+  pyarrow.parquet.write_table(
+      pyarrow.Table.from_arrays(columns, schema=schema), tmp_file)
+  os.rename(tmp_file, output_file)
+
+def write_items(output_file, items, school, download_file):
+  # Writes items extracted from download_file as records with FIELDS, in the
+  # format given by output_file's extension.  On the parse thread of a
+  # Pipeline, the write is queued for its writer thread instead.
+  pipeline = getattr(_pipelines, 'current', None)
+  if pipeline is not None:
+    pipeline.write_queue.put((output_file, items, school, download_file))
+    return
+  records = make_records(items, school, download_file)
+  old_records = []
+  if incremental is not None and os.path.isfile(output_file):
+    old_records = list(read_records(output_file))
+  with metrics.timer('write'), profiling('write'):
+    if output_file.endswith('.%s' % OUTPUT_FORMATS['parquet']):
+      write_parquet(output_file, records)
+    else:
+      write_jsonl(output_file, records)
+  for record in records:
+    metrics.inc('records', title=record['title'],
+                email='yes' if record['email'] else 'no')
+  errors = [e for e in quarantined if e['file'] == download_file]
+  counts = parse_counts.get(download_file, {})
+  if incremental is not None:
+    incremental.update(download_file, output_file, old_records, records,
+                       errors, counts)
+  if journal is not None:
+    journal.done('process', output_file, {
+        'download_sha1': download_sha1(download_file),
+        'output_sha1': file_sha1(output_file),
+        'errors': errors,
+        'counts': counts,
+    })
+
+def read_records(output_file):
+  # Yields the records of one output file as dicts.
+  if output_file.endswith('.%s' % OUTPUT_FORMATS['parquet']):
+    assert pyarrow is not None, 'reading parquet requires pyarrow'
+    columns = pyarrow.parquet.read_table(output_file).to_pydict()
+    for i in range(len(columns[FIELDS[0]])):
+      yield dict((field, columns[field][i]) for field in columns)
+  else:
+    with open(output_file) as fp:
+      for line in fp:
+        yield json.loads(line)
+
+def find_output_files(processed_dir, output_format=None):
+  ext = '.%s' % OUTPUT_FORMATS[output_format or OUTPUT_FORMAT]
+  output_files = []
+  for root, dirs, files in os.walk(processed_dir):
+    # Deltas of incremental runs are not output files either.
+    dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not (
+        root == processed_dir and d == DELTA_DIRNAME))
+    output_files.extend(
+        '%s/%s' % (root, f) for f in sorted(files)
+        if f.endswith(ext) and f != ERRORS_FILENAME
+        and not f.startswith('.'))
+  return output_files
+
+def conform_table(table, schema):
+  # Reorders and casts columns to schema, adding null columns for fields an
+  # older file or an all-null json column lacks.
+  columns = []
+  for field in schema:
+    if field.name in table.schema.names:
+      columns.append(table.column(field.name).cast(field.type))
+    else:
+      columns.append(pyarrow.chunked_array(
+          [pyarrow.nulls(table.num_rows, field.type)]))
+  return pyarrow.Table.from_arrays(columns, schema=schema)
+
+def load_items(output_files):
+  # Reads output files of either format into one pyarrow Table with FIELDS.
+  assert pyarrow is not None, 'loading items requires pyarrow'
+  schema = get_schema()
+  tables = []
+  for output_file in output_files:
+    if output_file.endswith('.%s' % OUTPUT_FORMATS['parquet']):
+      tables.append(pyarrow.parquet.read_table(output_file))
+    elif os.path.getsize(output_file) > 0:
+      tables.append(pyarrow.json.read_json(
+          output_file, parse_options=pyarrow.json.ParseOptions(
+              explicit_schema=schema)))
+  if not tables:
+    return schema.empty_table()
+  return pyarrow.concat_tables(
+      [conform_table(table, schema) for table in tables])
+
+def merge_items(output_files, merged_file):
+  table = load_items(output_files)
+  tmp_file = '%s.tmp' % merged_file
+  pyarrow.parquet.write_table(table, tmp_file)
+  os.rename(tmp_file, merged_file)
+  return table.num_rows
+
+####################
+# Incremental runs #
+####################
+
+MANIFEST_FILENAME = '.manifest.json'
+DELTA_DIRNAME = 'deltas'
+# Fields that identify a change to a person, so moving between pages is not.
+DELTA_FIELDS = ITEM_FIELDS + ['school']
+
+def get_record_key(record):
+  email = (record['email'] or '').strip().lower()
+  return email or get_name_key(record['name'] or '')
+
+def group_records(records):
+  groups = {}
+  for record in records:
+    groups.setdefault(get_record_key(record), []).append(
+        collections.OrderedDict(
+            (field, record[field]) for field in DELTA_FIELDS))
+  for group in groups.itervalues():
+    group.sort(key=json.dumps)
+  return groups
+
+class Incremental(object):
+  # Keeps a manifest of (url, download hash, output hash) for every output
+  # file under processed_dir.  Pages whose download and output match it are
+  # skipped; the records of the others are diffed against their previous
+  # output into a delta of added, removed and changed people for the run.
+  def __init__(self, processed_dir):
+    self.processed_dir = processed_dir
+    self.manifest_file = '%s/%s' % (processed_dir, MANIFEST_FILENAME)
+    self.lock = threading.Lock()
+    self.entries = {}
+    if os.path.isfile(self.manifest_file):
+      with open(self.manifest_file) as fp:
+        self.entries = json.load(fp)
+    self.seen = set()
+    self.updated = set()
+    self.old_records = []
+    self.new_records = []
+
+  def get_name(self, output_file):
+    return os.path.relpath(output_file, self.processed_dir)
+
+  def is_unchanged(self, download_file, output_file, counts):
+    # An unchanged page adds what its parse added to counts and quarantined,
+    # as if it had been parsed again.
+    name = self.get_name(output_file)
+    with self.lock:
+      self.seen.add(name)
+      entry = self.entries.get(name)
+    if (entry is None or not os.path.isfile(output_file)
+        or download_sha1(download_file) != entry['download_sha1']
+        or file_sha1(output_file) != entry['output_sha1']):
+      return False
+    add_counts(counts, entry.get('counts', {}))
+    add_quarantined(entry.get('errors', []))
+    return True
+
+  def update(self, download_file, output_file, old_records, new_records,
+             errors, counts):
+    name = self.get_name(output_file)
+    with self.lock:
+      self.seen.add(name)
+      self.updated.add(name)
+      self.old_records.extend(old_records)
+      self.new_records.extend(new_records)
+      self.entries[name] = {
+          'url': get_source_url(download_file),
+          'download_sha1': download_sha1(download_file),
+          'output_sha1': file_sha1(output_file),
+          'keys': sorted(set(get_record_key(r) for r in new_records)),
+          'errors': errors,
+          'counts': counts,
+      }
+      self.save()
+
+  def save(self):
+    write_file(self.manifest_file, json.dumps(self.entries, indent=1,
+                                              sort_keys=True))
+
+  def get_delta(self):
+    old, new = group_records(self.old_records), group_records(self.new_records)
+    # People also listed on pages that did not change were neither added nor
+    # removed, wherever else they appeared or disappeared.
+    kept = set()
+    for name, entry in self.entries.iteritems():
+      if name not in self.updated:
+        kept.update(entry.get('keys', []))
+    delta = []
+    for key in sorted(set(old) | set(new)):
+      if key in kept and (key not in old or key not in new):
+        continue
+      if key not in old:
+        delta.append({'op': 'added', 'key': key, 'records': new[key]})
+      elif key not in new:
+        delta.append({'op': 'removed', 'key': key, 'records': old[key]})
+      elif old[key] != new[key]:
+        delta.append({'op': 'changed', 'key': key, 'records': new[key],
+                      'old_records': old[key]})
+    return delta
+
+  def finish(self):
+    # Pages the run no longer produced are dropped along with their records,
+    # unless some downloads failed and they may be among them.
+    unseen = sorted(set(self.entries) - self.seen)
+    if unseen and failed_downloads:
+      print 'keeping %d pages not seen, as %d downloads failed' % (
+          len(unseen), len(failed_downloads))
+      unseen = []
+    for name in unseen:
+      output_file = '%s/%s' % (self.processed_dir, name)
+      if os.path.isfile(output_file):
+        self.old_records.extend(read_records(output_file))
+        os.remove(output_file)
+      del self.entries[name]
+    self.save()
+    delta = self.get_delta()
+    counts = dict((op, 0) for op in ('added', 'removed', 'changed'))
+    for change in delta:
+      counts[change['op']] += 1
+    print 'delta: %d added, %d removed, %d changed' % (
+        counts['added'], counts['removed'], counts['changed'])
+    if not delta:
+      return None
+    delta_dir = '%s/%s' % (self.processed_dir, DELTA_DIRNAME)
+    if not os.path.isdir(delta_dir):
+      os.makedirs(delta_dir)
+    delta_file = '%s/%s.jsonl' % (
+        delta_dir, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+    write_file(delta_file, ''.join(
+        '%s\n' % json.dumps(change) for change in delta))
+    print 'wrote delta to %s' % delta_file
+    return delta_file
+
+# Set by init() in --incremental mode.
+incremental = None
+
+###############
+# Run journal #
+###############
+
+JOURNAL_FILENAME = '.journal.jsonl'
+
+class Journal(object):
+  # Appends a line for every download and output completed by a run, with
+  # the hash of its content, and is removed once the run finishes.  A run
+  # restarted after dying midway skips the steps whose files still match,
+  # even when it would otherwise redo them.  A line cut short by the crash is
+  # ignored.
+  def __init__(self, processed_dir, resume=True):
+    self.journal_file = '%s/%s' % (processed_dir, JOURNAL_FILENAME)
+    self.lock = threading.Lock()
+    self.steps = {'fetch': {}, 'process': {}}
+    if resume and os.path.isfile(self.journal_file):
+      with open(self.journal_file) as fp:
+        for line in fp:
+          try:
+            step = json.loads(line)
+          except ValueError:
+            break
+          self.steps[step['step']][step['file']] = step['entry']
+      print 'resuming interrupted run: %d downloads and %d outputs done' % (
+          len(self.steps['fetch']), len(self.steps['process']))
+    self.mode = 'a' if resume else 'w'
+    self.fp = None
+
+  def done(self, step, afile, entry):
+    afile = os.path.abspath(afile)
+    line = '%s\n' % json.dumps({'step': step, 'file': afile, 'entry': entry})
+    with self.lock:
+      self.steps[step][afile] = entry
+      if self.fp is None:
+        self.fp = open(self.journal_file, self.mode)
+      self.fp.write(line)
+      self.fp.flush()
+      os.fsync(self.fp.fileno())
+
+  def get(self, step, afile):
+    with self.lock:
+      return self.steps[step].get(os.path.abspath(afile))
+
+  def is_fetched(self, download_file, url, post_data):
+    entry = self.get('fetch', download_file)
+    return (entry is not None and entry['url'] == url
+            and entry['post_data'] == post_data
+            and file_sha1(download_file) == entry['sha1'])
+
+  def is_processed(self, download_file, output_file, counts):
+    entry = self.get('process', output_file)
+    if (entry is None
+        or download_sha1(download_file) != entry['download_sha1']
+        or file_sha1(output_file) != entry['output_sha1']):
+      return False
+    add_counts(counts, entry.get('counts', {}))
+    add_quarantined(entry['errors'])
+    return True
+
+  def finish(self):
+    if self.fp is not None:
+      self.fp.close()
+    if os.path.isfile(self.journal_file):
+      os.remove(self.journal_file)
+
+# Set by init().
+journal = None
+
+def finish():
+  # Called by scrapers at the end of a run.
+  if incremental is not None:
+    incremental.finish()
+  write_quarantined()
+  report_failed_downloads()
+  if journal is not None:
+    journal.finish()
+  write_profiles()
+  write_metrics()
+
+###########
+# Metrics #
+###########
+
+# Timers, counters and histograms of a run, written by finish() to
+# metrics_file as Prometheus text, e.g. for node_exporter's textfile
+# collector, or as JSON, with every metric labeled with the school.  Stage
+# timers nest: download includes throttle, and parse, which only cache misses
+# take, includes soup and extract.
+METRICS_FORMATS = collections.OrderedDict([
+    ('prometheus', 'prom'),
+    ('json', 'json'),
+])
+METRICS_FORMAT = 'prometheus'
+METRICS_PREFIX = 'uniscrape_'
+# Upper bounds of the buckets of stage timers.
+STAGE_SECONDS_BUCKETS = [
+    0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+class Histogram(object):
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+
+  def get_cumulative(self):
+    # [(upper bound, observations up to it)], ending with +Inf.
+    cumulative = []
+    total = 0
+    for bound, count in zip(self.buckets + [float('inf')], self.counts):
+      total += count
+      cumulative.append((bound, total))
+    return cumulative
+
+class Metrics(object):
+  # Each metric is a name, without METRICS_PREFIX, and labels.  Safe to
+  # update from worker threads.
+  def __init__(self):
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.iteritems())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    key = (name, tuple(sorted(labels.iteritems())))
+    with self.lock:
+      self.gauges[key] = value
+
+  def observe(self, name, value, buckets, **labels):
+    key = (name, tuple(sorted(labels.iteritems())))
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = Histogram(buckets)
+      histogram.observe(value)
+
+  @contextlib.contextmanager
+  def timer(self, stage, **labels):
+    # Times the block into stage_seconds, also when it raises.
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe('stage_seconds', time.time() - start, STAGE_SECONDS_BUCKETS,
+                   stage=stage, **labels)
+
+  def get_stage_secs(self):
+    # Stage to (total secs, times), over all its labels.
+    stages = {}
+    with self.lock:
+      for (name, labels), histogram in self.histograms.iteritems():
+        if name == 'stage_seconds':
+          stage = dict(labels)['stage']
+          secs, times = stages.get(stage, (0.0, 0))
+          stages[stage] = (secs + histogram.sum, times + sum(histogram.counts))
+    return collections.OrderedDict(sorted(stages.iteritems()))
+
+  def to_json(self, labels):
+    metrics = []
+    with self.lock:
+      for kind, values in (('counter', self.counters),
+                           ('gauge', self.gauges)):
+        for (name, key_labels), value in sorted(values.iteritems()):
+          metrics.append({'name': METRICS_PREFIX + name, 'type': kind,
+                          'labels': dict(labels, **dict(key_labels)),
+                          'value': value})
+      for (name, key_labels), histogram in sorted(self.histograms.iteritems()):
+        metrics.append({
+            'name': METRICS_PREFIX + name, 'type': 'histogram',
+            'labels': dict(labels, **dict(key_labels)),
+            'buckets': [[format_metric_value(bound), count]
+                        for bound, count in histogram.get_cumulative()],
+            'sum': histogram.sum,
+            'count': sum(histogram.counts)})
+    return {'start': self.start, 'metrics': metrics}
+
+  def to_prometheus(self, labels):
+    lines = []
+    def add(name, key_labels, value, kind=None):
+      if kind is not None:
+        lines.append('# TYPE %s %s' % (name, kind))
+      lines.append('%s%s %s' % (
+          name, format_metric_labels(dict(labels, **dict(key_labels))),
+          format_metric_value(value)))
+    with self.lock:
+      for kind, values, suffix in (('counter', self.counters, '_total'),
+                                   ('gauge', self.gauges, '')):
+        last = None
+        for (name, key_labels), value in sorted(values.iteritems()):
+          name = METRICS_PREFIX + name + suffix
+          add(name, key_labels, value, kind if name != last else None)
+          last = name
+      last = None
+      for (name, key_labels), histogram in sorted(self.histograms.iteritems()):
+        name = METRICS_PREFIX + name
+        if name != last:
+          lines.append('# TYPE %s histogram' % name)
+          last = name
+        for bound, count in histogram.get_cumulative():
+          add('%s_bucket' % name,
+              key_labels + (('le', format_metric_value(bound)),), count)
+        add('%s_sum' % name, key_labels, histogram.sum)
+        add('%s_count' % name, key_labels, sum(histogram.counts))
+    return ''.join('%s\n' % line for line in lines)
+
+def format_metric_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(value) if isinstance(value, float) else str(value)
+
+def format_metric_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace(
+      '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+      for name, value in sorted(labels.iteritems()))
+
+# Reset by init(); metrics_file is set with --metrics_file.
+metrics = Metrics()
+metrics_file = None
+
+def write_metrics():
+  # Prints the time spent in each stage and writes metrics_file, if any.
+  now = time.time()
+  metrics.set('run_seconds', now - metrics.start)
+  metrics.set('last_run_timestamp_seconds', now)
+  stages = metrics.get_stage_secs()
+  if stages:
+    print 'time by stage: %s' % ', '.join(
+        '%s %.2fs (%d)' % (stage, secs, times)
+        for stage, (secs, times) in stages.iteritems())
+  if metrics_file is None:
+    return
+  labels = {'school': SCHOOL} if SCHOOL is not None else {}
+  if METRICS_FORMAT == 'json':
+    content = json.dumps(metrics.to_json(labels), indent=1, sort_keys=True)
+  else:
+    content = metrics.to_prometheus(labels).encode('utf-8')
+  metrics_dir = os.path.dirname(metrics_file)
+  if metrics_dir and not os.path.isdir(metrics_dir):
+    os.makedirs(metrics_dir)
+  write_file(metrics_file, content)
+  print 'wrote metrics to %s' % metrics_file
+
+#############
+# Profiling #
+#############
+
+# With --profile, the download, parse and write stages are profiled apart, so
+# that parsing shows without the network waits.  For each stage, finish()
+# writes <school>-<stage>.pstats from cProfile, and <school>-<stage>.collapsed
+# with the stacks sampled every PROFILE_SAMPLE_SECS, as flamegraph.pl reads
+# them.  With --profile_memory, the memory of parsing each page is traced too,
+# into <school>-memory.jsonl: how much it raised the peak resident size of the
+# process, and with tracemalloc (python 3 only) its peak and retained python
+# allocations and the lines that made the most.  The resident size is shared
+# by all threads, so it is best read with --no_pipeline.
+PROFILE_SAMPLE_SECS = 0.005
+MEMORY_TOP_LINES = 10
+# Units of ru_maxrss in bytes.
+MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+def get_maxrss():
+  # Peak resident size of the process so far, in bytes.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_BYTES
+
+def get_stack(frame):
+  # frame and its callers, outermost first, in collapsed stack format.
+  stack = []
+  while frame is not None:
+    code = frame.f_code
+    stack.append('%s (%s:%d)' % (
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+    frame = frame.f_back
+  return ';'.join(reversed(stack))
+
+class Profiler(object):
+  def __init__(self, profile_dir, memory=False):
+    self.profile_dir = profile_dir
+    self.memory = memory
+    self.lock = threading.Lock()
+    # (stage, thread id) to its cProfile.Profile.
+    self.profiles = {}
+    # Stage to the number of samples of each stack.
+    self.stacks = collections.defaultdict(collections.Counter)
+    # Thread id to the stage it is in.
+    self.active = {}
+    self.pages = []
+    self.stopped = threading.Event()
+    self.sampler = threading.Thread(target=self.sample)
+    self.sampler.daemon = True
+    self.sampler.start()
+    if memory and tracemalloc is not None:
+      tracemalloc.start()
+
+  def sample(self):
+    while not self.stopped.wait(PROFILE_SAMPLE_SECS):
+      frames = sys._current_frames()
+      with self.lock:
+        for thread_id, stage in self.active.iteritems():
+          frame = frames.get(thread_id)
+          if frame is not None:
+            self.stacks[stage][get_stack(frame)] += 1
+
+  @contextlib.contextmanager
+  def stage(self, stage, download_file=None):
+    # Profiles the block as stage, unless it is within another stage.
+    thread_id = threading.current_thread().ident
+    with self.lock:
+      if thread_id in self.active:
+        profile = None
+      else:
+        key = (stage, thread_id)
+        profile = self.profiles.get(key)
+        if profile is None:
+          profile = self.profiles[key] = cProfile.Profile()
+        self.active[thread_id] = stage
+    if profile is None:
+      yield
+      return
+    memory = self.memory and download_file is not None
+    if memory:
+      maxrss = get_maxrss()
+      if tracemalloc is not None:
+        tracemalloc.clear_traces()
+    profile.enable()
+    try:
+      yield
+    finally:
+      profile.disable()
+      with self.lock:
+        del self.active[thread_id]
+      if memory:
+        self.trace_page(download_file, maxrss)
+
+  def trace_page(self, download_file, start_maxrss):
+    maxrss = get_maxrss()
+    page = collections.OrderedDict([
+        ('file', download_file),
+        ('maxrss_bytes', maxrss),
+        ('maxrss_growth_bytes', maxrss - start_maxrss)])
+    if tracemalloc is not None:
+      current, peak = tracemalloc.get_traced_memory()
+      top = tracemalloc.take_snapshot().statistics('lineno')[:MEMORY_TOP_LINES]
+      page['peak_bytes'] = peak
+      page['retained_bytes'] = current
+      page['top'] = [[str(stat.traceback), stat.size] for stat in top]
+    self.pages.append(page)
+
+  def stop(self):
+    self.stopped.set()
+    self.sampler.join()
+    if self.memory and tracemalloc is not None:
+      tracemalloc.stop()
+
+  def write(self, prefix):
+    self.stop()
+    if not os.path.isdir(self.profile_dir):
+      os.makedirs(self.profile_dir)
+    stages = collections.defaultdict(list)
+    for (stage, _), profile in self.profiles.iteritems():
+      stages[stage].append(profile)
+    for stage, profiles in sorted(stages.iteritems()):
+      stats = pstats.Stats(profiles[0])
+      for profile in profiles[1:]:
+        stats.add(profile)
+      stats.dump_stats('%s/%s%s.pstats' % (self.profile_dir, prefix, stage))
+      write_file('%s/%s%s.collapsed' % (self.profile_dir, prefix, stage),
+                 ''.join('%s %d\n' % (stack, count) for stack, count in
+                         sorted(self.stacks[stage].iteritems())))
+    if self.memory:
+      write_file('%s/%smemory.jsonl' % (self.profile_dir, prefix), ''.join(
+          '%s\n' % json.dumps(page) for page in self.pages))
+    print 'wrote profiles of %s to %s' % (
+        ', '.join(sorted(stages)), self.profile_dir)
+
+# Set by init() with --profile.
+profiler = None
+
+@contextlib.contextmanager
+def profiling(stage, download_file=None):
+  # Profiles the block as stage with --profile; download_file is the page the
+  # block parses, if any, to trace memory for.
+  if profiler is None:
+    yield
+  else:
+    with profiler.stage(stage, download_file):
+      yield
+
+def write_profiles():
+  if profiler is not None:
+    profiler.write('%s-' % SCHOOL if SCHOOL is not None else '')
+
 ################
 # System utils #
 ################
 
-WGET = '/usr/local/bin/wget'
-SLEEP_SECS = 1
+# Maximum number of downloads in flight, across all hosts.
+MAX_WORKERS = 8
+# Maximum number of downloads in flight against a single host.
+MAX_PER_HOST = 2
+TIMEOUT_SECS = 60
+USER_AGENT = 'Mozilla/5.0 (compatible; uniscrape)'
 
-def wait(secs=SLEEP_SECS):
-  print 'sleeping for %d secs' % secs
-  time.sleep(secs)
+_print_lock = threading.Lock()
 
-def download(url, output_file, overwrite):
-  if os.path.isfile(output_file) and not overwrite:
-    print '%s exists and not overwritable' % output_file
+def log(msg):
+  # Print from worker threads without interleaving lines.
+  with _print_lock:
+    print msg
+
+def add_common_args(parser):
+  parser.add_argument('--max_workers', type=int, default=MAX_WORKERS)
+  parser.add_argument('--max_per_host', type=int, default=MAX_PER_HOST)
+  parser.add_argument('--host_rate', type=float, default=HOST_RATE,
+                      help='requests per second per host, 0 for unlimited')
+  parser.add_argument('--host_burst', type=int, default=HOST_BURST)
+  parser.add_argument('--refresh', action='store_true',
+                      help='revalidate existing downloads with the server')
+  parser.add_argument('--no_parse_cache', action='store_true',
+                      help='always re-parse downloads')
+  parser.add_argument('--parser', choices=BACKENDS, default=PARSER)
+  parser.add_argument('--no_stream', action='store_true',
+                      help='build the whole tree even for large tables')
+  parser.add_argument('--output_format', choices=OUTPUT_FORMATS.keys(),
+                      default=OUTPUT_FORMAT)
+  parser.add_argument('--no_quarantine', action='store_true',
+                      help='fail a page on a bad row instead of skipping it')
+  parser.add_argument('--no_resume', action='store_true',
+                      help='redo the steps done by an interrupted run')
+  parser.add_argument('--blob_store', default=None,
+                      help='directory to also keep every download in, '
+                      'compressed and deduplicated across runs')
+  parser.add_argument('--blob_compression', choices=BLOB_COMPRESSIONS,
+                      default=BLOB_COMPRESSION)
+  parser.add_argument('--snapshot', default=None,
+                      help='process the downloads in --blob_store as of this '
+                      'local time, %s, instead of fetching' %
+                      SNAPSHOT_FORMAT.replace('%', '%%'))
+  parser.add_argument('--incremental', action='store_true',
+                      help='revalidate downloads, reprocess only changed '
+                      'pages and write a delta of changed people')
+  parser.add_argument('--no_pipeline', action='store_true',
+                      help='parse and write pages only once all are fetched')
+  parser.add_argument('--metrics_file', default=None,
+                      help='file to write the timers and counters of the run '
+                      'to')
+  parser.add_argument('--metrics_format', choices=METRICS_FORMATS.keys(),
+                      default=METRICS_FORMAT)
+  parser.add_argument('--profile', default=None,
+                      help='directory to write profiles of the download, '
+                      'parse and write stages to; disables the parse cache')
+  parser.add_argument('--profile_memory', action='store_true',
+                      help='with --profile, also trace the memory of parsing '
+                      'each page')
+
+def init(args, school=None):
+  global METRICS_FORMAT, OVERWRITE_DOWNLOAD, OUTPUT_FORMAT, PARSE_CACHE, PARSER
+  global PIPELINE, QUARANTINE, SCHOOL, SNAPSHOT, STREAM_ROWS
+  global blob_store, errors_file, fetcher, incremental, journal, metrics
+  global metrics_file, profiler, rate_limiter, retry_budget
+  SCHOOL = school
+  metrics = Metrics()
+  metrics_file = args.metrics_file
+  METRICS_FORMAT = args.metrics_format
+  PARSER = args.parser
+  STREAM_ROWS = not args.no_stream
+  PIPELINE = not args.no_pipeline
+  QUARANTINE = not args.no_quarantine
+  errors_file = '%s/%s' % (args.processed_dir, ERRORS_FILENAME)
+  del quarantined[:]
+  OUTPUT_FORMAT = args.output_format
+  assert OUTPUT_FORMAT != 'parquet' or pyarrow is not None, (
+      'parquet output requires pyarrow')
+  if args.refresh or args.incremental:
+    OVERWRITE_DOWNLOAD = True
+  if args.incremental:
+    incremental = Incremental(args.processed_dir)
+  journal = Journal(args.processed_dir, not args.no_resume)
+  blob_store = None
+  if args.blob_store is not None:
+    blob_store = BlobStore(args.blob_store, args.blob_compression)
+  SNAPSHOT = None
+  snapshot_files.clear()
+  if args.snapshot is not None:
+    assert blob_store is not None, '--snapshot requires --blob_store'
+    SNAPSHOT = time.mktime(time.strptime(args.snapshot, SNAPSHOT_FORMAT))
+  if args.no_parse_cache:
+    PARSE_CACHE = False
+  assert args.profile is not None or not args.profile_memory, (
+      '--profile_memory requires --profile')
+  if profiler is not None:
+    profiler.stop()
+  profiler = None
+  if args.profile is not None:
+    PARSE_CACHE = False
+    profiler = Profiler(args.profile, args.profile_memory)
+  rate_limiter = RateLimiter(args.host_rate, args.host_burst)
+  retry_budget = RetryBudget()
+  del failed_downloads[:]
+  fetcher = Fetcher(args.max_workers, args.max_per_host)
+
+def get_host(url):
+  return urlparse.urlparse(url).netloc.lower()
+
+################
+# Rate limiter #
+################
+
+# Default per-host budget: HOST_RATE requests per second, with up to
+# HOST_BURST requests allowed back to back after the host has been idle.
+HOST_RATE = 1.0
+HOST_BURST = 1
+# Per-host (rate, burst) overrides.
+HOST_RATES = {}
+# Honor 429 (and 503 with Retry-After) by pausing the host and retrying.
+RESPECT_RETRY_AFTER = True
+BACKOFF_SECS = 5
+MAX_BACKOFF_SECS = 300
+
+class TokenBucket(object):
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = max(1, burst)
+    self.tokens = float(self.burst)
+    self.stamp = time.time()
+    self.paused_until = 0
+
+  def reserve(self):
+    # Takes a token and returns how long to wait before using it.  Tokens may
+    # go negative so that concurrent callers queue up in order.
+    now = time.time()
+    wait = max(0, self.paused_until - now)
+    if self.rate <= 0:
+      return wait
+    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+    self.tokens -= 1
+    if self.tokens < 0:
+      wait = max(wait, -self.tokens / self.rate)
+    return wait
+
+class RateLimiter(object):
+  def __init__(self, rate=HOST_RATE, burst=HOST_BURST, host_rates=HOST_RATES):
+    self.rate = rate
+    self.burst = burst
+    self.host_rates = host_rates
+    self.lock = threading.Lock()
+    self.buckets = {}
+
+  def bucket(self, host):
+    if host not in self.buckets:
+      rate, burst = self.host_rates.get(host, (self.rate, self.burst))
+      self.buckets[host] = TokenBucket(rate, burst)
+    return self.buckets[host]
+
+  def acquire(self, host):
+    with self.lock:
+      wait = self.bucket(host).reserve()
+    if wait > 0:
+      time.sleep(wait)
+
+  def backoff(self, host, secs):
+    secs = min(secs, MAX_BACKOFF_SECS)
+    log('backing off %s for %.1f secs' % (host, secs))
+    with self.lock:
+      bucket = self.bucket(host)
+      bucket.paused_until = max(bucket.paused_until, time.time() + secs)
+
+rate_limiter = RateLimiter()
+
+def parse_retry_after(value):
+  # Retry-After is either a number of seconds or an http date.
+  if value is None:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+  date = email.utils.parsedate_tz(value)
+  if date is None:
+    return None
+  return max(0, email.utils.mktime_tz(date) - time.time())
+
+def get_backoff_secs(error, attempt):
+  # Returns how long to pause the host before retrying after error: what the
+  # server asked for, else a random time up to BACKOFF_SECS doubled for each
+  # attempt so far, so that workers failing together do not retry together.
+  if isinstance(error, HttpError):
+    retry_after = parse_retry_after(error.headers.get('retry-after'))
+    if retry_after is not None:
+      return retry_after
+  return random.uniform(0, min(MAX_BACKOFF_SECS, BACKOFF_SECS * 2 ** attempt))
+
+###########
+# Retries #
+###########
+
+# Failed requests of these kinds (see classify_error) are retried.
+RETRY_KINDS = frozenset(['throttled', 'server', 'timeout', 'dns', 'connection'])
+# Retries allowed per url, and across the urls of a host and of the run; once
+# a budget is spent, further failures are final.
+MAX_RETRIES = 4
+HOST_RETRY_BUDGET = 20
+RUN_RETRY_BUDGET = 100
+
+def classify_error(error):
+  if isinstance(error, HttpError):
+    if error.status == 429 or (
+        error.status == 503 and 'retry-after' in error.headers):
+      return 'throttled'
+    if error.status >= 500:
+      return 'server'
+    return 'client'
+  # The more specific socket errors first.
+  if isinstance(error, socket.timeout):
+    return 'timeout'
+  if isinstance(error, socket.gaierror):
+    return 'dns'
+  if isinstance(error, (socket.error, httplib.HTTPException)):
+    return 'connection'
+  return 'other'
+
+class RetryBudget(object):
+  def __init__(self, per_host=HOST_RETRY_BUDGET, total=RUN_RETRY_BUDGET):
+    self.per_host = per_host
+    self.total = total
+    self.lock = threading.Lock()
+    self.hosts = {}
+
+  def take(self, host):
+    # Whether a request to host may be retried, using up one retry if so.
+    with self.lock:
+      left = self.hosts.get(host, self.per_host)
+      if left <= 0 or self.total <= 0:
+        return False
+      self.hosts[host] = left - 1
+      self.total -= 1
+      return True
+
+retry_budget = RetryBudget()
+
+class FetchError(Exception):
+  def __init__(self, url, kind, attempts, error):
+    Exception.__init__(self, '%s after %d attempts: %s (%s)' % (
+        kind, attempts, url, error))
+    self.url = url
+    self.kind = kind
+    self.attempts = attempts
+    self.error = error
+
+# Downloads that failed for good in this run, reported by finish().
+failed_downloads = []
+
+def report_failed_downloads():
+  if not failed_downloads:
+    return
+  print 'failed to fetch %d urls:' % len(failed_downloads)
+  for failure in failed_downloads:
+    print '  %s: %s (%s)' % (failure['kind'], failure['url'], failure['error'])
+
+###############
+# Http client #
+###############
+
+# Idle keep-alive connections kept per host.
+MAX_IDLE_PER_HOST = MAX_PER_HOST
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+ACCEPT_ENCODING = 'gzip, deflate'
+if brotli is not None:
+  ACCEPT_ENCODING += ', br'
+
+class HttpError(Exception):
+  def __init__(self, url, status, headers):
+    Exception.__init__(self, 'http status %d: %s' % (status, url))
+    self.url = url
+    self.status = status
+    self.headers = headers
+
+class Response(object):
+  def __init__(self, url, status, headers, body):
+    self.url = url
+    self.status = status
+    # Header names are lowercased.
+    self.headers = headers
+    self.body = body
+
+def decode_body(body, encoding):
+  encoding = (encoding or '').strip().lower()
+  if encoding in ('', 'identity'):
+    return body
+  if encoding in ('gzip', 'x-gzip'):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+  if encoding == 'deflate':
+    # Some servers send raw deflate streams without the zlib header.
+    try:
+      return zlib.decompress(body)
+    except zlib.error:
+      return zlib.decompress(body, -zlib.MAX_WBITS)
+  if encoding == 'br' and brotli is not None:
+    return brotli.decompress(body)
+  assert False, 'unsupported content encoding: %s' % encoding
+
+class ConnectionPool(object):
+  # Idle keep-alive connections to a single scheme://host:port.
+  def __init__(self, scheme, netloc, max_idle=MAX_IDLE_PER_HOST):
+    self.scheme = scheme
+    self.netloc = netloc
+    self.max_idle = max_idle
+    self.lock = threading.Lock()
+    self.idle = []
+
+  def get(self):
+    # Returns (connection, reused).
+    with self.lock:
+      if self.idle:
+        return self.idle.pop(), True
+    if self.scheme == 'https':
+      conn = httplib.HTTPSConnection(self.netloc, timeout=TIMEOUT_SECS)
+    else:
+      conn = httplib.HTTPConnection(self.netloc, timeout=TIMEOUT_SECS)
+    return conn, False
+
+  def put(self, conn):
+    with self.lock:
+      if len(self.idle) < self.max_idle:
+        self.idle.append(conn)
+        return
+    conn.close()
+
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for conn in idle:
+      conn.close()
+
+class HttpClient(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pools = {}
+
+  def pool(self, scheme, netloc):
+    key = (scheme, netloc.lower())
+    with self.lock:
+      if key not in self.pools:
+        self.pools[key] = ConnectionPool(scheme, netloc)
+      return self.pools[key]
+
+  def send(self, method, url, data, headers):
+    parts = urlparse.urlsplit(url)
+    assert parts.scheme in ('http', 'https'), 'unsupported url: %s' % url
+    path = parts.path or '/'
+    if parts.query:
+      path = '%s?%s' % (path, parts.query)
+    pool = self.pool(parts.scheme, parts.netloc)
+    while True:
+      conn, reused = pool.get()
+      try:
+        conn.request(method, path, data, headers)
+        response = conn.getresponse()
+        body = response.read()
+        break
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        # The server may have dropped an idle keep-alive connection; retry
+        # once on a fresh one.
+        if not reused:
+          raise
+    if response.will_close:
+      conn.close()
+    else:
+      pool.put(conn)
+    response_headers = dict(
+        (name.lower(), value) for name, value in response.getheaders())
+    body = decode_body(body, response_headers.get('content-encoding'))
+    return Response(url, response.status, response_headers, body)
+
+  def request(self, url, data=None, headers=None):
+    # Follows redirects and raises HttpError on error statuses.
+    method = 'GET' if data is None else 'POST'
+    request_headers = {
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': ACCEPT_ENCODING,
+    }
+    request_headers.update(headers or {})
+    if data is not None:
+      request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    for _ in range(MAX_REDIRECTS + 1):
+      response = self.send(method, url, data, request_headers)
+      if (response.status not in REDIRECT_STATUSES
+          or 'location' not in response.headers):
+        break
+      url = urlparse.urljoin(url, response.headers['location'])
+      if response.status in (301, 302, 303) and method == 'POST':
+        method, data = 'GET', None
+        del request_headers['Content-Type']
+    else:
+      assert False, 'too many redirects: %s' % url
+    if response.status >= 400:
+      raise HttpError(url, response.status, response.headers)
+    return response
+
+  def close(self):
+    with self.lock:
+      pools = self.pools.values()
+    for pool in pools:
+      pool.close()
+
+http_client = HttpClient()
+
+###########
+# Fetcher #
+###########
+
+# Set by a multi-school driver to share one download budget across processes.
+shared_slots = None
+
+class Fetcher(object):
+  def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST):
+    self.max_per_host = max_per_host
+    self.slots = shared_slots or threading.BoundedSemaphore(max_workers)
+
+  def request(self, url, post_data, headers=None):
+    # Retries transient failures, pausing the host in between, and raises
+    # FetchError once they are not worth retrying any more.
+    host = get_host(url)
+    attempt = 0
+    while True:
+      with metrics.timer('throttle'):
+        rate_limiter.acquire(host)
+      try:
+        with self.slots:
+          log('fetching %s' % url)
+          response = http_client.request(url, post_data, headers)
+        metrics.inc('requests', status=response.status)
+        return response
+      except Exception as e:
+        kind = classify_error(e)
+        metrics.inc('request_errors', kind=kind)
+        if (kind not in RETRY_KINDS
+            or (kind == 'throttled' and not RESPECT_RETRY_AFTER)
+            or attempt >= MAX_RETRIES or not retry_budget.take(host)):
+          raise FetchError(url, kind, attempt + 1, e)
+        metrics.inc('retries', kind=kind)
+        log('%s: %s (%r), retrying' % (url, kind, e))
+        rate_limiter.backoff(host, get_backoff_secs(e, attempt))
+        attempt += 1
+
+  def fetch_one(self, url, output_file, post_data):
+    adir, name = os.path.split(output_file)
+    meta = get_download_meta(adir)
+    entry = meta.get(name)
+    if not is_complete_download(output_file, url, post_data):
+      entry = None
+    headers = {}
+    if entry is not None and post_data is None:
+      if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+      if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    response = self.request(url, post_data, headers)
+    now = time.time()
+    if response.status == 304:
+      log('%s not modified' % url)
+      metrics.inc('downloads', result='not_modified')
+      entry['checked'] = now
+    else:
+      metrics.inc('fetched_bytes', len(response.body))
+      digest = sha1(response.body)
+      fetched = now
+      if entry is not None and entry['sha1'] == digest:
+        log('%s unchanged' % url)
+        metrics.inc('downloads', result='unchanged')
+        fetched = entry['fetched']
+      else:
+        metrics.inc('downloads', result='fetched')
+        write_file(output_file, response.body)
+      entry = {
+          'url': url,
+          'post_data': post_data,
+          'etag': response.headers.get('etag'),
+          'last_modified': response.headers.get('last-modified'),
+          'sha1': digest,
+          'fetched': fetched,
+          'checked': now,
+      }
+    meta.put(name, entry)
+    if blob_store is not None:
+      body = response.body if response.status != 304 else None
+      blob_store.add(SCHOOL, url, post_data, entry['fetched'], entry['sha1'],
+                     lambda: body if body is not None else
+                     read_download(output_file))
+    if journal is not None:
+      journal.done('fetch', output_file,
+                   {'url': url, 'post_data': post_data, 'sha1': entry['sha1']})
     return output_file
-  wait()
-  cmd = '%s "%s" -O %s -q' % (WGET, url, output_file)
-  print 'running command: %s' % cmd
-  assert os.system(cmd) == 0
-  return output_file
 
+  def fetch(self, jobs, overwrite, on_fetched=None):
+    # Each job is (url, output_file) or (url, output_file, post_data).
+    # Returns output files in job order, None for those that failed (see
+    # failed_downloads).  on_fetched(i, output_file) is called as soon as the
+    # i-th job is done, unless it failed, from the thread that did it.  In
+    # SNAPSHOT mode nothing is fetched and the output files are read from the
+    # blob store.
+    if SNAPSHOT is not None:
+      metrics.inc('downloads', len(jobs), result='snapshot')
+      results = [get_snapshot_file(*job) for job in jobs]
+      if on_fetched is not None:
+        for i, output_file in enumerate(results):
+          if output_file is not None:
+            on_fetched(i, output_file)
+      return results
+    results = [None] * len(jobs)
+    host_queues = {}
+    for i, job in enumerate(jobs):
+      url, output_file, post_data = (tuple(job) + (None,))[:3]
+      if journal is not None and journal.is_fetched(
+          output_file, url, post_data):
+        print '%s was fetched before the run was interrupted' % output_file
+        metrics.inc('downloads', result='resumed')
+        results[i] = output_file
+        if on_fetched is not None:
+          on_fetched(i, output_file)
+        continue
+      if not overwrite and os.path.isfile(output_file):
+        if is_complete_download(output_file, url, post_data):
+          print '%s exists and not overwritable' % output_file
+          metrics.inc('downloads', result='existing')
+          results[i] = output_file
+          if on_fetched is not None:
+            on_fetched(i, output_file)
+          continue
+        print '%s may be incomplete, fetching again' % output_file
+      host_queues.setdefault(get_host(url), Queue.Queue()).put(
+          (i, url, output_file, post_data))
+
+    def work(queue):
+      while True:
+        try:
+          i, url, output_file, post_data = queue.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          with metrics.timer('download'), profiling('download'):
+            results[i] = self.fetch_one(url, output_file, post_data)
+        except Exception as e:
+          log('failed to fetch %s: %s' % (url, e))
+          metrics.inc('downloads', result='failed')
+          if isinstance(e, FetchError):
+            kind, error = e.kind, e.error
+          else:
+            kind, error = classify_error(e), e
+          failed_downloads.append({'url': url, 'file': output_file,
+                                   'kind': kind, 'error': str(error)})
+          continue
+        if on_fetched is not None:
+          on_fetched(i, results[i])
+
+    # One queue per host drained by at most max_per_host threads, so a long
+    # crawl of one host never holds up the others.
+    threads = []
+    for queue in host_queues.itervalues():
+      for _ in range(min(self.max_per_host, queue.qsize())):
+        thread = threading.Thread(target=work, args=(queue,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+      thread.join()
+    return results
+
+fetcher = Fetcher()
+
+def download_all(jobs, overwrite, on_fetched=None):
+  return fetcher.fetch(jobs, overwrite, on_fetched)
+
+def download(url, output_file, overwrite):
+  return download_all([(url, output_file)], overwrite)[0]
+
+##############
+# Pagination #
+##############
+
+# Pages fetched per round when probing a listing for its end.
+PROBE_BATCH = MAX_WORKERS
+
+def get_max_page_param(download_file, param='page'):
+  # Largest value of the query parameter param in the page's links, which is
+  # the last page for pagers like drupal's; None if there is no such link.
+  content = read_download(download_file)
+  pages = re.findall(r'[?&;]%s=(\d+)' % re.escape(param), content)
+  return max(int(page) for page in pages) if pages else None
+
+class Listing(object):
+  # A paginated listing.  make_job(page) is the download job of a page and
+  # get_last_page(download_file) reads the last page off the first one, or
+  # returns None if it cannot tell.  Then pages are probed until one for
+  # which is_empty(download_file) holds; without is_empty the listing is
+  # taken to have a single page.  fetch_listings() fills in pages as (page,
+  # download_file) in page order.
+  def __init__(self, make_job, first_page, get_last_page, is_empty=None):
+    self.make_job = make_job
+    self.first_page = first_page
+    self.get_last_page = get_last_page
+    self.is_empty = is_empty
+    self.url = make_job(first_page)[0]
+    self.pages = []
+    self.next_page = None
+
+def fetch_listings(listings, overwrite, probe_batch=None, on_page=None):
+  # Fetches the first page of every listing in one batch, then all the pages
+  # known to remain in a second one.  Listings without a page count are
+  # probed probe_batch pages at a time alongside.  Pages that fail to
+  # download are left out, and a probe stops at the first one.
+  # on_page(listing, page, download_file) is called for every page as soon as
+  # it is known to be part of its listing: when it is fetched, or for a
+  # probed page, once its round of probing is done.
+  probe_batch = probe_batch or PROBE_BATCH
+  def on_first_fetched(i, download_file):
+    if on_page is not None:
+      on_page(listings[i], listings[i].first_page, download_file)
+  first_files = download_all(
+      [listing.make_job(listing.first_page) for listing in listings],
+      overwrite, on_first_fetched)
+  jobs = []
+  probing = []
+  for listing, first_file in zip(listings, first_files):
+    if first_file is None:
+      listing.pages = []
+      continue
+    listing.pages = [(listing.first_page, first_file)]
+    last_page = listing.get_last_page(first_file)
+    if last_page is not None:
+      log('%s: pages %d to %d' % (listing.url, listing.first_page, last_page))
+      jobs.extend((listing, page)
+                  for page in range(listing.first_page + 1, last_page + 1))
+    elif listing.is_empty is not None:
+      listing.next_page = listing.first_page + 1
+      probing.append(listing)
+  while jobs or probing:
+    for listing in probing:
+      jobs.extend((listing, page) for page in range(
+          listing.next_page, listing.next_page + probe_batch))
+      listing.next_page += probe_batch
+    def on_fetched(i, download_file):
+      listing, page = jobs[i]
+      if on_page is not None and listing not in probing:
+        on_page(listing, page, download_file)
+    download_files = download_all(
+        [listing.make_job(page) for listing, page in jobs], overwrite,
+        on_fetched)
+    ended = set()
+    for (listing, page), download_file in zip(jobs, download_files):
+      if listing in probing:
+        if listing in ended:
+          continue
+        if download_file is None:
+          log('%s: pages %d to %d, probing stopped by a failed download' % (
+              listing.url, listing.first_page, page - 1))
+          ended.add(listing)
+          continue
+        if listing.is_empty(download_file):
+          log('%s: pages %d to %d, by probing' % (
+              listing.url, listing.first_page, page - 1))
+          ended.add(listing)
+          continue
+      if download_file is not None:
+        listing.pages.append((page, download_file))
+        if on_page is not None and listing in probing:
+          on_page(listing, page, download_file)
+    probing = [listing for listing in probing if listing not in ended]
+    jobs = []
+  return listings
+
+############
+# Pipeline #
+############
+
+# Pages are parsed and written while others are still being fetched: fetch
+# threads hand each download to a bounded queue drained by a parse thread,
+# which hands the items to a bounded queue drained by a writer thread.  A full
+# queue blocks the stage feeding it, so that a slow parse slows fetching down
+# instead of piling up pages.  There is a single parse thread, as the scrapers
+# count into module-level dicts and parsing holds the GIL anyway.
+PIPELINE = True
+PIPELINE_QUEUE_SIZE = 4
+
+# The Pipeline whose parse thread this is, if any.
+_pipelines = threading.local()
+
+class Pipeline(object):
+  # Wraps the fetching of pages, with feed(func) as the callback of
+  # download_all() or fetch_listings(): func is then called with the
+  # callback's arguments on the parse thread, and the write_items() it makes
+  # run on the writer thread.  Leaving the block waits for every page, and
+  # reraises the first error of either thread; pages after it are skipped.
+  # Without PIPELINE, the pages are processed in turn on leaving the block.
+  def __init__(self, queue_size=None):
+    queue_size = queue_size or PIPELINE_QUEUE_SIZE
+    self.threaded = PIPELINE
+    self.parse_queue = Queue.Queue(queue_size)
+    self.write_queue = Queue.Queue(queue_size)
+    self.pending = []
+    self.error = None
+    self.threads = []
+    if self.threaded:
+      for target in (self.parse, self.write):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if not self.threaded:
+      if exc_type is None:
+        for func, args in self.pending:
+          func(*args)
+      return False
+    self.parse_queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    if exc_type is None and self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+    return False
+
+  def feed(self, func):
+    return lambda *args: self.put(func, args)
+
+  def put(self, func, args):
+    # Blocks while the parse queue is full.
+    if not self.threaded:
+      self.pending.append((func, args))
+    elif self.error is None:
+      self.parse_queue.put((func, args))
+
+  def parse(self):
+    _pipelines.current = self
+    while True:
+      job = self.parse_queue.get()
+      if job is None:
+        break
+      if self.error is not None:
+        continue
+      func, args = job
+      try:
+        func(*args)
+      except BaseException:
+        self.error = sys.exc_info()
+    self.write_queue.put(None)
+
+  def write(self):
+    while True:
+      job = self.write_queue.get()
+      if job is None:
+        return
+      if self.error is not None:
+        continue
+      try:
+        write_items(*job)
+      except BaseException:
+        self.error = sys.exc_info()